@@ -0,0 +1,176 @@
+"""
+Benchmark of the webhook ingestion path:
+ProcessWebhookView -> WebhookEventTrigger.from_request -> WebhookEvent.process
+
+The webhook fixtures in tests/fixtures/webhooks are replayed through the
+view against a throwaway test database. The Paypal API is stubbed with the
+TestApi of tests/conftest.py, and signature verification is skipped.
+
+Usage:
+	python benchmarks/webhooks.py [--database sqlite|postgres] [--requests N]
+		[--event-type TYPE ...] [--deferred]
+
+The postgres database settings are the ones of tests/settings.py.
+Event types whose resource is not implemented respond with HTTP 500 and are
+reported as errors; they still measure the cost of storing the trigger.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+from collections import defaultdict
+from unittest import mock
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(BASE_DIR, "tests", "fixtures", "webhooks")
+
+
+def setup_django(database, deferred):
+	import django
+	from django.conf import settings
+
+	from tests import settings as test_settings
+
+	options = {k: getattr(test_settings, k) for k in dir(test_settings) if k.isupper()}
+	options["DEBUG"] = False
+	options["PAYPAL_WEBHOOK_DEFERRED"] = deferred
+	if database == "sqlite":
+		options["DATABASES"] = {
+			"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+		}
+		# The migrations use postgres-specific fields
+		options["MIGRATION_MODULES"] = {"djpaypal": None}
+
+	settings.configure(**options)
+	django.setup()
+
+
+def get_fixtures(event_types):
+	fixtures = {}
+	for filename in sorted(os.listdir(FIXTURES_DIR)):
+		name = filename[:-len(".json")]
+		if event_types and name not in event_types:
+			continue
+		with open(os.path.join(FIXTURES_DIR, filename), "r") as f:
+			fixtures[name] = json.load(f)
+	return fixtures
+
+
+class QueryCounter:
+	def __init__(self):
+		self.count = 0
+
+	def __call__(self, execute, sql, params, many, context):
+		self.count += 1
+		return execute(sql, params, many, context)
+
+
+def percentile(values, p):
+	values = sorted(values)
+	index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+	return values[index]
+
+
+def run(fixtures, requests):
+	from django.db import connection
+	from django.test import RequestFactory
+
+	from djpaypal.models import WebhookEventTrigger
+	from djpaypal.views import ProcessWebhookView
+
+	view = ProcessWebhookView.as_view()
+	factory = RequestFactory()
+	results = defaultdict(lambda: {"timings": [], "queries": 0, "errors": 0})
+
+	with mock.patch.object(WebhookEventTrigger, "verify", return_value=True):
+		for name, data in fixtures.items():
+			result = results[name]
+			for i in range(requests):
+				# Every delivery is a new event, with its own transmission id
+				body = json.dumps(dict(data, id="%s-%i" % (data["id"], i)))
+				request = factory.post(
+					"/webhook/", data=body, content_type="application/json",
+					HTTP_PAYPAL_TRANSMISSION_ID="%s-%i" % (name, i),
+				)
+
+				counter = QueryCounter()
+				with connection.execute_wrapper(counter):
+					start = time.perf_counter()
+					response = view(request)
+					result["timings"].append(time.perf_counter() - start)
+				result["queries"] += counter.count
+				if response.status_code != 200:
+					result["errors"] += 1
+
+	return results
+
+
+def report(results):
+	row = "{:<48} {:>8} {:>8} {:>10} {:>9} {:>9} {:>9}"
+	print(row.format(
+		"event type", "requests", "errors", "req/s", "p50 ms", "p99 ms", "queries"
+	))
+	all_timings, all_queries, all_errors = [], 0, 0
+	for name, result in results.items():
+		timings = result["timings"]
+		all_timings += timings
+		all_queries += result["queries"]
+		all_errors += result["errors"]
+		print(row.format(
+			name, len(timings), result["errors"],
+			"%.1f" % (len(timings) / sum(timings)),
+			"%.2f" % (percentile(timings, 50) * 1000),
+			"%.2f" % (percentile(timings, 99) * 1000),
+			"%.1f" % (result["queries"] / len(timings)),
+		))
+
+	if all_timings:
+		print(row.format(
+			"total", len(all_timings), all_errors,
+			"%.1f" % (len(all_timings) / sum(all_timings)),
+			"%.2f" % (percentile(all_timings, 50) * 1000),
+			"%.2f" % (percentile(all_timings, 99) * 1000),
+			"%.1f" % (all_queries / len(all_timings)),
+		))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Benchmark webhook ingestion")
+	parser.add_argument("--database", choices=("sqlite", "postgres"), default="sqlite")
+	parser.add_argument(
+		"--requests", type=int, default=100, help="Number of requests per event type"
+	)
+	parser.add_argument(
+		"--event-type", action="append", dest="event_types", default=[],
+		help="Only replay this fixture (eg. payment.sale.completed), can be repeated"
+	)
+	parser.add_argument(
+		"--deferred", action="store_true",
+		help="Benchmark deferred mode (PAYPAL_WEBHOOK_DEFERRED)"
+	)
+	args = parser.parse_args(argv)
+
+	# Some fixtures have naive datetimes
+	warnings.filterwarnings("ignore", message=".*received a naive datetime")
+
+	sys.path[:0] = [BASE_DIR, os.path.join(BASE_DIR, "src")]
+	setup_django(args.database, args.deferred)
+
+	from django.db import connection
+
+	# Stub the Paypal API
+	from tests import conftest  # noqa
+
+	fixtures = get_fixtures(args.event_types)
+	old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+	try:
+		report(run(fixtures, args.requests))
+	finally:
+		connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -1,15 +1,21 @@
-from datetime import datetime
+from functools import partial
 
 from django.contrib import admin
+from django.db import transaction
+from django.db.models import Q
 from django.utils.html import format_html
+from django.utils.timezone import now
 
-from . import models
+from . import enums, models
+from .models.billing import invalidate_entitlement_cache
 from .settings import PAYPAL_WEBHOOK_ID
 from .utils import admin_urlify
 
 
 class BasePaypalObjectAdmin(admin.ModelAdmin):
-	_common_fields = ("id", "djpaypal_created", "djpaypal_updated", "livemode")
+	_common_fields = (
+		"id", "djpaypal_created", "djpaypal_updated", "livemode", "djpaypal_data_hash"
+	)
 	change_form_template = "djpaypal/admin/change_form.html"
 
 	def get_fieldsets(self, request, obj=None):
@@ -21,7 +27,7 @@ class BasePaypalObjectAdmin(admin.ModelAdmin):
 		)
 
 	def get_list_display(self, request):
-		return ("__str__", ) + self.list_display + self._common_fields[1:]
+		return ("__str__", ) + self.list_display + self._common_fields[1:4]
 
 	def get_list_filter(self, request):
 		return self.list_filter + ("livemode", )
@@ -38,7 +44,7 @@ class BasePaypalObjectAdmin(admin.ModelAdmin):
 
 @admin.register(models.BillingPlan)
 class BillingPlanAdmin(BasePaypalObjectAdmin):
-	list_display = ("state", "type", "create_time")
+	list_display = ("state", "type", "price_summary", "create_time")
 	list_filter = ("type", "state", "create_time", "update_time")
 	raw_id_fields = ("payment_definitions", )
 
@@ -51,12 +57,13 @@ class BillingPlanAdmin(BasePaypalObjectAdmin):
 
 @admin.register(models.BillingAgreement)
 class BillingAgreementAdmin(BasePaypalObjectAdmin):
-	list_display = (admin_urlify("user"), "state")
-	list_filter = ("state", )
+	list_display = (admin_urlify("user"), "state", "last_payment_date", "next_billing_date")
+	list_filter = ("state", "regular_frequency")
 	search_fields = (
 		"user__id",
 		"user__username",
-		"user__email"
+		"user__email",
+		"payer_email",
 	)
 	raw_id_fields = ("user", "payer_model")
 
@@ -71,9 +78,10 @@ class BillingAgreementAdmin(BasePaypalObjectAdmin):
 	cancel_immediately.short_description = "Cancel selected agreements immediately"
 
 	def expire(self, request, queryset):
-		for agreement in queryset:
-			agreement.end_of_period = datetime.now()
-			agreement.save()
+		# Update directly: save() would recompute the end of period
+		user_ids = set(queryset.values_list("user_id", flat=True))
+		queryset.update(end_of_period=now())
+		transaction.on_commit(partial(invalidate_entitlement_cache, *user_ids))
 	expire.short_description = "Mark selected agreements as expired"
 
 	actions = (cancel, cancel_immediately, expire)
@@ -186,10 +194,12 @@ class WebhookEventAdmin(BasePaypalObjectAdmin):
 @admin.register(models.WebhookEventTrigger)
 class WebhookEventTriggerAdmin(admin.ModelAdmin):
 	list_display = (
-		"created", "updated", "valid", "processed", "exception", "webhook_event"
+		"created", "updated", "valid", "processed", "pending", "exception", "webhook_event",
+		"processing_ms", "api_calls", "db_queries",
 	)
-	list_filter = ("created", "valid", "processed")
+	list_filter = ("created", "valid", "processed", "pending")
 	raw_id_fields = ("webhook_event", )
+	readonly_fields = ("raw_body", )
 
 	def reverify(self, request, queryset):
 		for trigger in queryset:
@@ -208,3 +218,25 @@ class WebhookEventTriggerAdmin(admin.ModelAdmin):
 		return False
 
 	actions = (reverify, reprocess)
+
+
+@admin.register(models.WebhookHandlerJob)
+class WebhookHandlerJobAdmin(admin.ModelAdmin):
+	list_display = (
+		"handler", "status", "duration_ms", "exception", "created", "webhook_event"
+	)
+	list_filter = ("status", "created", "handler")
+	raw_id_fields = ("webhook_event", )
+	readonly_fields = ("started", "duration_ms", "exception", "traceback")
+
+	def requeue(self, request, queryset):
+		# Running jobs are only requeued if their worker presumably died
+		queryset.filter(
+			~Q(status=enums.WebhookHandlerJobStatus.running) |
+			models.WebhookHandlerJob.get_stale_running_q()
+		).update(status=enums.WebhookHandlerJobStatus.pending)
+
+	def has_add_permission(self, request):
+		return False
+
+	actions = (requeue, )
@@ -0,0 +1,185 @@
+"""
+Paypal API client.
+
+All the paypalrestsdk requests go through the default API object. dj-paypal
+replaces it with a PaypalApi instance, which keeps a pool of persistent
+connections to Paypal and retries requests which failed temporarily.
+"""
+import datetime
+import hashlib
+import logging
+import time
+
+import requests
+from django.core.cache import caches
+from paypalrestsdk import api
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+from .instrumentation import record_api_call
+
+
+log = logging.getLogger(__name__)
+
+# Responses to idempotent requests that are retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Access tokens are evicted from the cache this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+# How long a process may hold the lock to request a new access token
+TOKEN_LOCK_TIMEOUT = 10
+
+
+def build_session(pool_size=10, max_retries=3, backoff_factor=0.5):
+	"""
+	Returns a requests Session with a connection pool of `pool_size`
+	connections per host, which retries idempotent requests up to
+	`max_retries` times with an exponential backoff.
+	"""
+	retry = Retry(
+		total=max_retries, backoff_factor=backoff_factor,
+		status_forcelist=RETRY_STATUSES, raise_on_status=False,
+	)
+	adapter = HTTPAdapter(
+		pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+	)
+	session = requests.Session()
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+
+class PaypalApi(api.Api):
+	"""
+	A paypalrestsdk Api which sends its requests through a pooled session.
+
+	Supports the following options on top of the paypalrestsdk ones:
+	- pool_size: Maximum number of connections kept alive (default: 10)
+	- timeout: Request timeout in seconds (default: 30)
+	- max_retries: Maximum number of retries (default: 3)
+	- backoff_factor: Backoff factor between retries (default: 0.5)
+	- token_cache: Django cache alias used to share the access token (default: None)
+	"""
+	def __init__(self, options=None, **kwargs):
+		super().__init__(options, **kwargs)
+		self.timeout = self.options.get("timeout", 30)
+		self.session = build_session(
+			pool_size=self.options.get("pool_size", 10),
+			max_retries=self.options.get("max_retries", 3),
+			backoff_factor=self.options.get("backoff_factor", 0.5),
+		)
+		self.token_cache = self.options.get("token_cache")
+		self._last_access_token = None
+
+	@property
+	def token_cache_key(self):
+		client_id = hashlib.sha256(self.client_id.encode("utf-8")).hexdigest()
+		return "djpaypal:token:{}:{}".format(self.mode, client_id)
+
+	def get_token_hash(self, authorization_code=None, refresh_token=None, headers=None):
+		"""
+		Same as paypalrestsdk.Api.get_token_hash(), but the client credentials
+		access token is shared through the Django cache, so that all the
+		processes use the same token.
+
+		A lock ensures that only one process requests a new token at a time.
+		"""
+		if authorization_code is not None or refresh_token is not None or not self.token_cache:
+			return super().get_token_hash(authorization_code, refresh_token, headers=headers)
+
+		self.validate_token_hash()
+		if self.token_hash is not None:
+			return self.token_hash
+
+		cache = caches[self.token_cache]
+		if not self._load_cached_token(cache):
+			lock_key = self.token_cache_key + ":lock"
+			if cache.add(lock_key, True, timeout=TOKEN_LOCK_TIMEOUT):
+				try:
+					if not self._load_cached_token(cache):
+						self._request_token(cache, headers)
+				finally:
+					cache.delete(lock_key)
+			elif not self._wait_for_cached_token(cache):
+				self._request_token(cache, headers)
+
+		self._last_access_token = self.token_hash["access_token"]
+		return self.token_hash
+
+	def _load_cached_token(self, cache):
+		cached = cache.get(self.token_cache_key)
+		if cached is None:
+			return False
+
+		if cached["token_hash"]["access_token"] == self._last_access_token:
+			# We already used and dropped that token before it expired,
+			# which means that Paypal rejected it.
+			cache.delete(self.token_cache_key)
+			return False
+
+		self.token_hash = cached["token_hash"]
+		self.token_request_at = datetime.datetime.fromtimestamp(cached["requested_at"])
+		return True
+
+	def _wait_for_cached_token(self, cache):
+		deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+		while time.monotonic() < deadline:
+			time.sleep(0.1)
+			if self._load_cached_token(cache):
+				return True
+		return False
+
+	def _request_token(self, cache, headers):
+		token_hash = super().get_token_hash(headers=headers)
+		timeout = token_hash.get("expires_in", 0) - TOKEN_EXPIRY_MARGIN
+		if timeout > 0:
+			cache.set(self.token_cache_key, {
+				"token_hash": token_hash,
+				"requested_at": self.token_request_at.timestamp(),
+			}, timeout=timeout)
+
+	def http_call(self, url, method, **kwargs):
+		log.info("Request[%s]: %s", method, url)
+
+		start_time = time.perf_counter()
+		response = self.session.request(
+			method, url, proxies=self.proxies, timeout=self.timeout, **kwargs
+		)
+		duration = time.perf_counter() - start_time
+		record_api_call(duration)
+		metrics.api_request(method, url, response.status_code, duration)
+		log.info(
+			"Response[%d]: %s, Duration: %ss.", response.status_code, response.reason, duration
+		)
+
+		debug_id = response.headers.get("PayPal-Debug-Id")
+		if debug_id:
+			log.debug("debug_id: %s", debug_id)
+
+		return self.handle_response(response, response.content.decode("utf-8"))
+
+
+_default_session = None
+
+
+def configure(options):
+	"""
+	Replace the paypalrestsdk default API object with a PaypalApi instance.
+	"""
+	api.__api__ = PaypalApi(options)
+	return api.__api__
+
+
+def get_session():
+	"""
+	Returns the HTTP session of the default API object, or a shared pooled
+	session if it is not a PaypalApi instance.
+	"""
+	global _default_session
+
+	if isinstance(api.__api__, PaypalApi):
+		return api.__api__.session
+	if _default_session is None:
+		_default_session = build_session()
+	return _default_session
@@ -24,3 +24,36 @@ def check_paypal_api_key(app_configs=None, **kwargs):
 			messages.append(checks.Critical(msg, hint=hint, id="djpaypal.C002"))
 
 	return messages
+
+
+@checks.register("djpaypal")
+def check_paypal_metrics(app_configs=None, **kwargs):
+	"""Check that prometheus_client is installed if metrics are enabled"""
+	from .metrics import prometheus_client
+
+	messages = []
+	if djpaypal_settings.PAYPAL_METRICS and prometheus_client is None:
+		msg = "PAYPAL_METRICS is enabled, but prometheus_client is not installed."
+		hint = "Install prometheus_client, or disable PAYPAL_METRICS."
+		messages.append(checks.Error(msg, hint=hint, id="djpaypal.E001"))
+
+	return messages
+
+
+@checks.register("djpaypal")
+def check_paypal_webhook_body_compression(app_configs=None, **kwargs):
+	"""Check that the webhook body compression method is available"""
+	from .utils import zstandard
+
+	messages = []
+	compression = djpaypal_settings.PAYPAL_WEBHOOK_BODY_COMPRESSION
+	if compression not in (None, "zlib", "zstd"):
+		msg = "Invalid PAYPAL_WEBHOOK_BODY_COMPRESSION specified: {}.".format(repr(compression))
+		hint = "PAYPAL_WEBHOOK_BODY_COMPRESSION must be None, 'zlib' or 'zstd'."
+		messages.append(checks.Error(msg, hint=hint, id="djpaypal.E002"))
+	elif compression == "zstd" and zstandard is None:
+		msg = "PAYPAL_WEBHOOK_BODY_COMPRESSION is 'zstd', but zstandard is not installed."
+		hint = "Install zstandard, or use 'zlib'."
+		messages.append(checks.Error(msg, hint=hint, id="djpaypal.E003"))
+
+	return messages
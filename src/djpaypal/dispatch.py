@@ -0,0 +1,184 @@
+"""
+Dispatching of webhook events to the handlers registered with
+`djpaypal.models.webhooks.webhook_handler`.
+
+Handler patterns are stored in a trie keyed on the dot-separated segments
+of the event type. A `*` segment matches exactly one segment, except as the
+last segment of a pattern where it matches all the remaining segments (one
+or more). Patterns with partial wildcards (eg. `billing.subscription.re-*`)
+are matched with fnmatch.
+
+Resolving the handlers of an event type is done once, then memoized until
+a handler is connected or disconnected.
+
+Each handler has an execution mode: sync handlers are called inline, async
+handlers on a thread pool once the transaction commits, and deferred
+handlers by the djpaypal_run_webhook_handlers management command.
+"""
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+
+from .settings import PAYPAL_WEBHOOK_HANDLER_THREADS
+
+
+PATTERN_RE = re.compile(r"^[a-z0-9_*-]+(\.[a-z0-9_*-]+)*$")
+
+SYNC = "sync"
+ASYNC = "async"
+DEFERRED = "deferred"
+HANDLER_MODES = (SYNC, ASYNC, DEFERRED)
+
+
+def get_receiver_name(receiver):
+	"""
+	Return the dotted path identifying a receiver.
+	"""
+	module = getattr(receiver, "__module__", None) or ""
+	name = getattr(receiver, "__qualname__", None) or getattr(receiver, "__name__", None)
+	return "%s.%s" % (module, name or repr(receiver))
+
+
+class _Node:
+	__slots__ = ("children", "wildcard", "receivers", "tail_receivers")
+
+	def __init__(self):
+		self.children = {}
+		# The child for a "*" segment in the middle of a pattern
+		self.wildcard = None
+		# Receivers of patterns ending at this node
+		self.receivers = {}
+		# Receivers of patterns ending with a "*" segment after this node
+		self.tail_receivers = {}
+
+
+class WebhookDispatcher:
+	def __init__(self):
+		self._root = _Node()
+		self._fnmatch_receivers = {}
+		self._counter = 0
+		self._modes = {}
+		self._names = {}
+		self._cache = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def normalize_pattern(pattern):
+		pattern = pattern.lower()
+		if not PATTERN_RE.match(pattern):
+			raise ValueError("Invalid webhook event pattern: %r" % (pattern))
+		return pattern
+
+	def _get_receivers(self, pattern, create=False):
+		"""
+		Return the receiver dict in which receivers of the pattern are stored.
+		"""
+		segments = pattern.split(".")
+		if any("*" in segment and segment != "*" for segment in segments):
+			return self._fnmatch_receivers.setdefault(pattern, {})
+
+		node = self._root
+		for i, segment in enumerate(segments):
+			if segment == "*" and i == len(segments) - 1:
+				return node.tail_receivers
+			if segment == "*":
+				if node.wildcard is None and create:
+					node.wildcard = _Node()
+				child = node.wildcard
+			else:
+				child = node.children.get(segment)
+				if child is None and create:
+					child = node.children[segment] = _Node()
+			if child is None:
+				return {}
+			node = child
+
+		return node.receivers
+
+	def connect(self, pattern, receiver, mode=SYNC):
+		pattern = self.normalize_pattern(pattern)
+		if mode not in HANDLER_MODES:
+			raise ValueError("Invalid webhook handler mode: %r" % (mode))
+		with self._lock:
+			self._modes[receiver] = mode
+			self._names[get_receiver_name(receiver)] = receiver
+			receivers = self._get_receivers(pattern, create=True)
+			if receiver not in receivers:
+				self._counter += 1
+				receivers[receiver] = self._counter
+			self._cache = {}
+
+	def disconnect(self, pattern, receiver):
+		pattern = self.normalize_pattern(pattern)
+		with self._lock:
+			self._get_receivers(pattern).pop(receiver, None)
+			self._cache = {}
+
+	def _resolve(self, event_type):
+		segments = event_type.lower().split(".")
+		matches = {}
+
+		def visit(node, i):
+			if i < len(segments):
+				matches.update(node.tail_receivers)
+				child = node.children.get(segments[i])
+				if child is not None:
+					visit(child, i + 1)
+				if node.wildcard is not None:
+					visit(node.wildcard, i + 1)
+			else:
+				matches.update(node.receivers)
+
+		visit(self._root, 0)
+
+		for pattern, receivers in self._fnmatch_receivers.items():
+			if fnmatchcase(event_type.lower(), pattern):
+				matches.update(receivers)
+
+		# Call the receivers in the order they were connected
+		return tuple(sorted(matches, key=matches.__getitem__))
+
+	def get_receivers(self, event_type):
+		"""
+		Return the receivers matching the event type, in connection order.
+		"""
+		try:
+			return self._cache[event_type]
+		except KeyError:
+			pass
+
+		with self._lock:
+			cache = self._cache
+			receivers = cache[event_type] = self._resolve(event_type)
+		return receivers
+
+	def get_mode(self, receiver):
+		return self._modes.get(receiver, SYNC)
+
+	def get_receiver(self, name):
+		"""
+		Return the connected receiver with the given name (see get_receiver_name()).
+		"""
+		return self._names.get(name)
+
+
+webhook_dispatcher = WebhookDispatcher()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+	"""
+	Return the thread pool running the async webhook handlers.
+	"""
+	global _executor
+	if _executor is None:
+		with _executor_lock:
+			if _executor is None:
+				_executor = ThreadPoolExecutor(
+					max_workers=PAYPAL_WEBHOOK_HANDLER_THREADS,
+					thread_name_prefix="djpaypal-webhook-handler",
+				)
+	return _executor
@@ -289,3 +289,10 @@ class SalePaymentHoldStatus(Enum):
 class SalePaymentHoldReason(Enum):
 	PAYMENT_HOLD = _("Payment hold")
 	SHIPPING_RISK_HOLD = _("Shipping risk hold")
+
+
+class WebhookHandlerJobStatus(Enum):
+	pending = _("Pending")
+	running = _("Running")
+	succeeded = _("Succeeded")
+	failed = _("Failed")
@@ -0,0 +1,100 @@
+"""
+Instrumentation of the database queries and Paypal API calls made while
+processing webhooks and syncing objects.
+
+>>> with instrument(sender=BillingPlan, label="sync") as stats:
+>>>     BillingPlan.objects.sync_data(plans)
+>>> print(stats.db_queries, stats.api_calls)
+
+Database queries are counted on the default database connection of the
+current thread. API calls are those made by the djpaypal PaypalApi client,
+in the current context (including the threads started by `sync_data()`).
+"""
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from django.db import connections
+from django.dispatch import Signal
+
+from .settings import PAYPAL_INSTRUMENTATION
+
+
+# Provides arguments:
+# - stats (ProcessingStats)
+
+stats_recorded = Signal()
+
+_active_stats = ContextVar("djpaypal_active_stats", default=())
+
+
+class ProcessingStats:
+	def __init__(self, label=""):
+		self.label = label
+		self.duration = 0.0
+		self.db_queries = 0
+		self.db_time = 0.0
+		self.api_calls = 0
+		self.api_time = 0.0
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<ProcessingStats %s: %.1fms, %i queries (%.1fms), %i API calls (%.1fms)>" % (
+			self.label, self.duration_ms, self.db_queries, self.db_time * 1000,
+			self.api_calls, self.api_time * 1000,
+		)
+
+	@property
+	def duration_ms(self):
+		return int(self.duration * 1000)
+
+	def record_api_call(self, duration):
+		with self._lock:
+			self.api_calls += 1
+			self.api_time += duration
+
+	def __call__(self, execute, sql, params, many, context):
+		# Database execute wrapper
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.db_queries += 1
+			self.db_time += time.perf_counter() - start
+
+
+@contextmanager
+def instrument(sender=None, label="", using="default"):
+	"""
+	Record the database queries and API calls made within the block into
+	a ProcessingStats object, then send the stats_recorded signal.
+
+	Instrumented blocks can be nested; queries and API calls are recorded
+	in all the active ProcessingStats.
+	"""
+	stats = ProcessingStats(label)
+	token = _active_stats.set(_active_stats.get() + (stats, ))
+	start = time.perf_counter()
+	try:
+		with connections[using].execute_wrapper(stats):
+			yield stats
+	finally:
+		stats.duration = time.perf_counter() - start
+		_active_stats.reset(token)
+		stats_recorded.send(sender=sender, stats=stats)
+
+
+def maybe_instrument(sender=None, label=""):
+	"""
+	Same as instrument() if settings.PAYPAL_INSTRUMENTATION is enabled,
+	otherwise a no-op context manager yielding None.
+	"""
+	if not PAYPAL_INSTRUMENTATION:
+		return nullcontext()
+	return instrument(sender=sender, label=label)
+
+
+def record_api_call(duration):
+	for stats in _active_stats.get():
+		stats.record_api_call(duration)
@@ -0,0 +1,42 @@
+from django.core.management import BaseCommand
+
+from djpaypal import models
+
+
+class Command(BaseCommand):
+	help = "Populate the denormalized fields of the existing billing agreements"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--batch-size", type=int, default=500,
+			help="Number of billing agreements updated per query"
+		)
+
+	def handle(self, *args, **options):
+		model = models.BillingAgreement
+		fields = None
+		updated = 0
+		last_pk = ""
+		while True:
+			batch = list(
+				model.objects.filter(pk__gt=last_pk).order_by("pk")
+				.only("pk", "agreement_details", "payer", "plan")[:options["batch_size"]]
+			)
+			if not batch:
+				break
+
+			for obj in batch:
+				data = model.get_denormalized_data({
+					"agreement_details": obj.agreement_details,
+					"payer": obj.payer,
+					"plan": obj.plan,
+				})
+				for field, value in data.items():
+					setattr(obj, field, value)
+				fields = list(data)
+
+			model.objects.bulk_update(batch, fields)
+			updated += len(batch)
+			last_pk = batch[-1].pk
+
+		self.stdout.write("Backfilled %i billing agreements" % (updated))
@@ -7,9 +7,21 @@ from djpaypal import models
 class Command(BaseCommand):
 	help = "Syncs plan data from upstream Paypal"
 
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--bulk", action="store_true",
+			help="Write the plans to the database using bulk queries"
+		)
+		parser.add_argument(
+			"--concurrency", type=int,
+			help="Maximum number of concurrent API requests (default: PAYPAL_SYNC_CONCURRENCY)"
+		)
+
 	def handle(self, *args, **options):
 		for status in ("created", "active"):
 			all_plans = paypal_models.BillingPlan.all({"status": status})
 			if all_plans.plans is None:
 				continue
-			models.BillingPlan.objects.sync_data(all_plans.plans)
+			models.BillingPlan.objects.sync_data(
+				all_plans.plans, bulk=options["bulk"], concurrency=options["concurrency"]
+			)
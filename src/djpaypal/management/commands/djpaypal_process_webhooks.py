@@ -0,0 +1,40 @@
+import time
+
+from django.core.management import BaseCommand
+
+from djpaypal import models
+
+
+class Command(BaseCommand):
+	help = "Verify and process pending (deferred) webhooks"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--batch-size", type=int, default=100,
+			help="Number of webhooks claimed per transaction"
+		)
+		parser.add_argument(
+			"--forever", action="store_true",
+			help="Keep polling for pending webhooks instead of exiting when there are none left"
+		)
+		parser.add_argument(
+			"--interval", type=float, default=1.0,
+			help="Seconds to wait between polls when there are no pending webhooks"
+		)
+
+	def handle(self, *args, **options):
+		while True:
+			triggers = models.WebhookEventTrigger.process_pending(
+				batch_size=options["batch_size"]
+			)
+			for trigger in triggers:
+				if trigger.exception:
+					self.stderr.write("Error processing webhook %r: %s" % (
+						trigger.id, trigger.exception
+					))
+			if triggers:
+				self.stdout.write("Processed %i webhooks" % (len(triggers)))
+			elif options["forever"]:
+				time.sleep(options["interval"])
+			else:
+				break
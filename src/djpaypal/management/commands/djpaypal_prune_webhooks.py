@@ -0,0 +1,117 @@
+import gzip
+import json
+import os
+from datetime import timedelta
+
+from django.core import serializers
+from django.core.management import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from djpaypal import models
+from djpaypal.settings import PAYPAL_WEBHOOK_RETENTION
+
+
+# Pending triggers are never pruned
+TRIGGER_STATES = {
+	"processed": Q(processed=True),
+	"failed": Q(valid=True, processed=False, pending=False),
+	"invalid": Q(valid=False, pending=False),
+}
+
+
+class Command(BaseCommand):
+	help = "Delete (and optionally archive) old webhook triggers and events"
+
+	def add_arguments(self, parser):
+		for state in TRIGGER_STATES:
+			parser.add_argument(
+				"--%s" % (state), type=int, metavar="DAYS",
+				default=PAYPAL_WEBHOOK_RETENTION.get(state),
+				help="Delete %s webhooks older than this many days" % (state)
+			)
+		parser.add_argument(
+			"--batch-size", type=int, default=1000,
+			help="Number of rows deleted per transaction"
+		)
+		parser.add_argument(
+			"--archive", metavar="DIRECTORY",
+			help="Archive the deleted rows to a gzipped JSON lines file in this directory"
+		)
+		parser.add_argument(
+			"--dry-run", action="store_true",
+			help="Only count the webhooks which would be deleted"
+		)
+
+	def handle(self, *args, **options):
+		self.batch_size = options["batch_size"]
+		self.dry_run = options["dry_run"]
+		self.archive = None
+		if options["archive"] and not self.dry_run:
+			if not os.path.isdir(options["archive"]):
+				raise CommandError("Not a directory: %r" % (options["archive"]))
+			filename = now().strftime("djpaypal-webhooks-%Y%m%dT%H%M%S.jsonl.gz")
+			self.archive = gzip.open(os.path.join(options["archive"], filename), "wt")
+			self.stdout.write("Archiving to %s" % (self.archive.name))
+
+		try:
+			event_retention = None
+			for state, condition in TRIGGER_STATES.items():
+				days = options[state]
+				if days is None:
+					continue
+				cutoff = now() - timedelta(days=days)
+				queryset = models.WebhookEventTrigger.objects.filter(condition, created__lt=cutoff)
+				deleted = self.prune(queryset)
+				self.stdout.write("Pruned %i %s webhook triggers" % (deleted, state))
+				if state == "processed":
+					event_retention = cutoff
+
+			if event_retention is not None:
+				# Events of the pruned processed triggers, which nothing refers to anymore
+				queryset = models.WebhookEvent.objects.filter(
+					create_time__lt=event_retention, webhookeventtrigger__isnull=True
+				)
+				deleted = self.prune(queryset)
+				self.stdout.write("Pruned %i webhook events" % (deleted))
+		finally:
+			if self.archive:
+				self.archive.close()
+
+	def prune(self, queryset):
+		"""
+		Delete the objects of the queryset in batches of self.batch_size.
+		Returns the number of deleted objects.
+		"""
+		if self.dry_run:
+			return queryset.count()
+
+		model = queryset.model
+		deleted = 0
+		while True:
+			with transaction.atomic():
+				ids = list(queryset.order_by("pk").values_list("pk", flat=True)[:self.batch_size])
+				if not ids:
+					break
+				batch = model.objects.filter(pk__in=ids)
+				if self.archive:
+					self.archive_objects(batch)
+				batch.delete()
+				deleted += len(ids)
+
+		return deleted
+
+	def archive_objects(self, queryset):
+		objs = list(queryset.order_by("pk"))
+		bodies = {}
+		if queryset.model is models.WebhookEventTrigger:
+			# Archive the decompressed body
+			bodies = {obj.pk: obj.raw_body for obj in objs}
+
+		for data in serializers.serialize("python", objs):
+			if data["pk"] in bodies:
+				data["fields"]["body"] = bodies[data["pk"]]
+				del data["fields"]["body_compressed"]
+			self.archive.write(json.dumps(data, cls=DjangoJSONEncoder) + "\n")
@@ -0,0 +1,92 @@
+from collections import defaultdict
+from functools import partial
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from djpaypal import enums, models
+from djpaypal.models.billing import (
+	EXPIRED_END_OF_PERIOD, get_frequency_delta, invalidate_entitlement_cache
+)
+
+
+class Command(BaseCommand):
+	help = "Recompute the end of period of the billing agreements"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--batch-size", type=int, default=1000,
+			help="Number of billing agreements loaded and updated per query"
+		)
+		parser.add_argument(
+			"--dry-run", action="store_true",
+			help="Only count the billing agreements whose end of period would change"
+		)
+
+	def handle(self, *args, **options):
+		model = models.BillingAgreement
+		# Same as save(): the end of period of cancelled agreements is kept
+		queryset = model.objects.exclude(state=enums.BillingAgreementState.Cancelled).only(
+			"pk", "user_id", "end_of_period", "last_payment_date",
+			"regular_frequency", "regular_frequency_interval",
+		)
+		checked, changed = 0, 0
+		last_pk = ""
+		while True:
+			batch = list(queryset.filter(pk__gt=last_pk).order_by("pk")[:options["batch_size"]])
+			if not batch:
+				break
+
+			objs = self.recompute(batch)
+			if objs and not options["dry_run"]:
+				with transaction.atomic():
+					model.objects.bulk_update(objs, ["end_of_period"])
+					transaction.on_commit(partial(
+						invalidate_entitlement_cache, *{obj.user_id for obj in objs}
+					))
+			checked += len(batch)
+			changed += len(objs)
+			last_pk = batch[-1].pk
+
+		self.stdout.write("%s the end of period of %i of %i billing agreements" % (
+			"Would change" if options["dry_run"] else "Changed", changed, checked
+		))
+
+	def recompute(self, batch):
+		"""
+		Set the end of period of the billing agreements of the batch.
+		Returns those whose end of period changed.
+		"""
+		# The denormalized fields have not been backfilled yet
+		missing = [obj for obj in batch if not obj.regular_frequency]
+		if missing:
+			fallback = models.BillingAgreement.objects.only(
+				"pk", "agreement_details", "plan"
+			).in_bulk([obj.pk for obj in missing])
+			for obj in missing:
+				data = models.BillingAgreement.get_denormalized_data({
+					"agreement_details": fallback[obj.pk].agreement_details,
+					"plan": fallback[obj.pk].plan,
+				})
+				obj.last_payment_date = data["last_payment_date"]
+				obj.regular_frequency = data["regular_frequency"]
+				obj.regular_frequency_interval = data["regular_frequency_interval"]
+
+		# Build the period delta once per frequency
+		groups = defaultdict(list)
+		for obj in batch:
+			groups[obj.regular_frequency, obj.regular_frequency_interval].append(obj)
+
+		ret = []
+		for (frequency, interval), objs in groups.items():
+			delta = get_frequency_delta(frequency, interval) if frequency else None
+			for obj in objs:
+				if obj.last_payment_date and delta:
+					end_of_period = obj.last_payment_date + delta
+				else:
+					end_of_period = EXPIRED_END_OF_PERIOD
+				if end_of_period != obj.end_of_period:
+					obj.end_of_period = end_of_period
+					ret.append(obj)
+
+		return ret
@@ -0,0 +1,158 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+import django
+from django.apps import apps
+from django.core.management import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive, make_aware
+
+
+def parse_date_argument(value):
+	date = parse_datetime(value)
+	if date is None:
+		day = parse_date(value)
+		if day is None:
+			raise ValueError("Invalid date: %r" % (value))
+		date = datetime.combine(day, datetime.min.time())
+	if is_naive(date):
+		date = make_aware(date)
+	return date
+
+
+# Note: djpaypal.models is imported locally, so that this module can be
+# imported by the (spawned) worker processes before Django is set up.
+
+def init_worker():
+	if not apps.ready:
+		django.setup()
+
+
+def reprocess_triggers(ids, event_types=None):
+	"""
+	Reprocess the WebhookEventTrigger objects with the given ids.
+
+	Returns a tuple of the number of processed, failed and skipped triggers.
+	"""
+	from djpaypal import models
+
+	processed = failed = skipped = 0
+	for trigger in models.WebhookEventTrigger.objects.filter(id__in=ids).order_by("id"):
+		event_type = trigger.data.get("event_type", "").lower()
+		if event_types and event_type not in event_types:
+			skipped += 1
+		elif trigger.reprocess():
+			processed += 1
+		else:
+			failed += 1
+
+	return processed, failed, skipped
+
+
+class Command(BaseCommand):
+	help = "Reprocess the valid webhooks which were not processed successfully"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--since", type=parse_date_argument,
+			help="Only reprocess webhooks received after this date"
+		)
+		parser.add_argument(
+			"--until", type=parse_date_argument,
+			help="Only reprocess webhooks received before this date"
+		)
+		parser.add_argument(
+			"--event-type", action="append", dest="event_types",
+			help="Only reprocess webhooks of this event type (can be repeated)"
+		)
+		parser.add_argument(
+			"--exception",
+			help="Only reprocess webhooks whose exception contains this text"
+		)
+		parser.add_argument(
+			"--chunk-size", type=int, default=500,
+			help="Number of webhooks reprocessed per batch"
+		)
+		parser.add_argument(
+			"--workers", type=int, default=1,
+			help="Number of worker processes"
+		)
+
+	def handle(self, *args, **options):
+		if options["workers"] < 1 or options["chunk_size"] < 1:
+			raise CommandError("--workers and --chunk-size must be positive")
+
+		from djpaypal import models
+
+		queryset = models.WebhookEventTrigger.objects.filter(
+			valid=True, processed=False, pending=False
+		)
+		if options["since"]:
+			queryset = queryset.filter(created__gte=options["since"])
+		if options["until"]:
+			queryset = queryset.filter(created__lt=options["until"])
+		if options["exception"]:
+			queryset = queryset.filter(exception__icontains=options["exception"])
+
+		event_types = None
+		if options["event_types"]:
+			event_types = {event_type.lower() for event_type in options["event_types"]}
+
+		ids = queryset.order_by("id").values_list("id", flat=True).iterator(
+			chunk_size=options["chunk_size"]
+		)
+
+		self.processed = self.failed = self.skipped = 0
+		start_time = time.monotonic()
+		if options["workers"] == 1:
+			for chunk in self.get_chunks(ids, options["chunk_size"]):
+				self.add_results(reprocess_triggers(chunk, event_types))
+		else:
+			self.reprocess_in_pool(ids, event_types, options["workers"], options["chunk_size"])
+		duration = time.monotonic() - start_time
+
+		total = self.processed + self.failed
+		self.stdout.write(
+			"Reprocessed %i webhooks in %.2fs (%.1f/s): %i processed, %i errors, %i skipped" % (
+				total, duration, total / duration if duration else 0,
+				self.processed, self.failed, self.skipped
+			)
+		)
+
+	def reprocess_in_pool(self, ids, event_types, workers, chunk_size):
+		executor = ProcessPoolExecutor(
+			max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+			initializer=init_worker,
+		)
+		with executor:
+			futures = set()
+			for chunk in self.get_chunks(ids, chunk_size):
+				if len(futures) >= workers * 2:
+					# Do not queue up the whole table
+					done, futures = wait(futures, return_when=FIRST_COMPLETED)
+					for future in done:
+						self.add_results(future.result())
+				futures.add(executor.submit(reprocess_triggers, chunk, event_types))
+
+			for future in futures:
+				self.add_results(future.result())
+
+	def get_chunks(self, ids, chunk_size):
+		chunk = []
+		for id in ids:
+			chunk.append(id)
+			if len(chunk) >= chunk_size:
+				yield chunk
+				chunk = []
+		if chunk:
+			yield chunk
+
+	def add_results(self, results):
+		processed, failed, skipped = results
+		self.processed += processed
+		self.failed += failed
+		self.skipped += skipped
+		if failed:
+			self.stderr.write("%i webhooks failed to reprocess" % (failed))
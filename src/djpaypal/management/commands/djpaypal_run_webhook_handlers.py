@@ -0,0 +1,38 @@
+import time
+
+from django.core.management import BaseCommand
+
+from djpaypal import models
+
+
+class Command(BaseCommand):
+	help = "Run the pending deferred (and orphaned async) webhook handlers"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--batch-size", type=int, default=100,
+			help="Number of handler jobs claimed per transaction"
+		)
+		parser.add_argument(
+			"--forever", action="store_true",
+			help="Keep polling for pending jobs instead of exiting when there are none left"
+		)
+		parser.add_argument(
+			"--interval", type=float, default=1.0,
+			help="Seconds to wait between polls when there are no pending jobs"
+		)
+
+	def handle(self, *args, **options):
+		while True:
+			jobs = models.WebhookHandlerJob.process_pending(batch_size=options["batch_size"])
+			for job in jobs:
+				if job.exception:
+					self.stderr.write("Error running %s for webhook event %r: %s" % (
+						job.handler, job.webhook_event_id, job.exception
+					))
+			if jobs:
+				self.stdout.write("Ran %i webhook handlers" % (len(jobs)))
+			elif options["forever"]:
+				time.sleep(options["interval"])
+			else:
+				break
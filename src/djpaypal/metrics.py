@@ -0,0 +1,105 @@
+"""
+Prometheus metrics of the webhooks and Paypal API calls.
+
+Requires prometheus_client, and settings.PAYPAL_METRICS to be enabled.
+The metrics are registered in the default prometheus_client registry; they
+can be exposed with `djpaypal.views.MetricsView`.
+When disabled, recording a metric is a no-op.
+"""
+import re
+from urllib.parse import urlparse
+
+from .settings import PAYPAL_METRICS
+
+
+try:
+	import prometheus_client
+except ImportError:
+	prometheus_client = None
+
+
+ENABLED = bool(PAYPAL_METRICS and prometheus_client)
+
+# Paypal object ids (P-123..., I-ABC..., WH-...) are replaced in API endpoints
+_PATH_SEGMENT_RE = re.compile(r"^[a-z][a-z0-9-]*$")
+
+if prometheus_client is not None:
+	WEBHOOKS = prometheus_client.Counter(
+		"djpaypal_webhooks", "Webhooks by event type and status "
+		"(received, valid, invalid, processed, failed)",
+		["event_type", "status"],
+	)
+	WEBHOOK_VERIFICATION_SECONDS = prometheus_client.Histogram(
+		"djpaypal_webhook_verification_seconds", "Time spent verifying webhook signatures",
+	)
+	WEBHOOK_PROCESSING_SECONDS = prometheus_client.Histogram(
+		"djpaypal_webhook_processing_seconds", "Time spent processing webhooks",
+		["event_type"],
+	)
+	API_REQUEST_SECONDS = prometheus_client.Histogram(
+		"djpaypal_api_request_seconds", "Latency of the Paypal API requests",
+		["method", "endpoint", "status"],
+	)
+	SYNC_BATCH_SIZE = prometheus_client.Histogram(
+		"djpaypal_sync_batch_size", "Number of objects synced by sync_data() calls",
+		["model"], buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+	)
+
+
+def get_endpoint(url):
+	"""
+	Return the path of an API url, with the object ids replaced by {id}.
+	"""
+	return "/".join(
+		segment if not segment or _PATH_SEGMENT_RE.match(segment) else "{id}"
+		for segment in urlparse(url).path.split("/")
+	)
+
+
+def get_event_type_label(trigger):
+	"""
+	Return the event type of a trigger, as a metric label.
+
+	The event type comes from the (possibly unverified) request body: event
+	types which are not known (see WEBHOOK_SIGNALS) are reported as "unknown",
+	so that requests cannot create an unbounded number of time series.
+	"""
+	from .models.webhooks import WEBHOOK_SIGNALS
+
+	event_type = trigger.event_type
+	if not isinstance(event_type, str) or event_type.lower() not in WEBHOOK_SIGNALS:
+		return "unknown"
+	return event_type.upper()
+
+
+def webhook_received(trigger):
+	if ENABLED:
+		WEBHOOKS.labels(get_event_type_label(trigger), "received").inc()
+
+
+def webhook_verified(trigger, valid, duration):
+	if ENABLED:
+		WEBHOOK_VERIFICATION_SECONDS.observe(duration)
+		WEBHOOKS.labels(get_event_type_label(trigger), "valid" if valid else "invalid").inc()
+
+
+def webhook_processed(trigger, duration):
+	if ENABLED:
+		event_type = get_event_type_label(trigger)
+		WEBHOOK_PROCESSING_SECONDS.labels(event_type).observe(duration)
+		WEBHOOKS.labels(event_type, "processed").inc()
+
+
+def webhook_failed(trigger):
+	if ENABLED:
+		WEBHOOKS.labels(get_event_type_label(trigger), "failed").inc()
+
+
+def api_request(method, url, status, duration):
+	if ENABLED:
+		API_REQUEST_SECONDS.labels(method, get_endpoint(url), status).observe(duration)
+
+
+def sync_batch(model, size):
+	if ENABLED:
+		SYNC_BATCH_SIZE.labels(model._meta.label).observe(size)
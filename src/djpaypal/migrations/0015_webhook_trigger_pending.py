@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0014_use_models_jsonfield'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='pending',
+            field=models.BooleanField(db_index=True, default=False, help_text='Whether the trigger is waiting to be verified and processed (deferred mode).'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+from django.db import migrations, models
+
+
+def backfill_transmission_id(apps, schema_editor):
+    WebhookEventTrigger = apps.get_model("djpaypal", "WebhookEventTrigger")
+    seen = set()
+    batch = []
+    queryset = WebhookEventTrigger.objects.only("id", "headers").order_by("id")
+    for trigger in queryset.iterator(chunk_size=1000):
+        transmission_id = (trigger.headers or {}).get("paypal-transmission-id")
+        # Only the first delivery of each webhook keeps the transmission id
+        if not transmission_id or transmission_id in seen:
+            continue
+        seen.add(transmission_id)
+        trigger.transmission_id = transmission_id
+        batch.append(trigger)
+        if len(batch) >= 1000:
+            WebhookEventTrigger.objects.bulk_update(batch, ["transmission_id"])
+            batch = []
+    WebhookEventTrigger.objects.bulk_update(batch, ["transmission_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0015_webhook_trigger_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='transmission_id',
+            field=models.CharField(blank=True, editable=False, max_length=128, null=True),
+        ),
+        migrations.RunPython(backfill_transmission_id, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='webhookeventtrigger',
+            name='transmission_id',
+            field=models.CharField(blank=True, editable=False, help_text='The paypal-transmission-id header, unique to each webhook delivered.', max_length=128, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0016_webhook_trigger_transmission_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingagreement',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='billingplan',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='chargemodel',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='dispute',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='paymentdefinition',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='djpaypal_data_hash',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the API data the object was last synced from.', max_length=64),
+        ),
+    ]
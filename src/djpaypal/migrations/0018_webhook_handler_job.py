@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0017_paypal_object_data_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookHandlerJob',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('handler', models.CharField(help_text='Dotted path of the handler function.', max_length=255)),
+                ('status', models.CharField(choices=[('failed', 'Failed'), ('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded')], db_index=True, default='pending', max_length=16)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('duration_ms', models.PositiveIntegerField(blank=True, help_text='How long the handler ran for, in milliseconds.', null=True)),
+                ('exception', models.CharField(blank=True, max_length=128)),
+                ('traceback', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('webhook_event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='djpaypal.webhookevent')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0018_webhook_handler_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='api_calls',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of Paypal API calls made while processing the webhook.', null=True),
+        ),
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='db_queries',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of database queries made while processing the webhook.', null=True),
+        ),
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='processing_ms',
+            field=models.PositiveIntegerField(blank=True, help_text='How long processing the webhook took, in milliseconds (instrumentation).', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0019_webhook_trigger_instrumentation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='body_compressed',
+            field=models.BinaryField(blank=True, help_text='The compressed body, if settings.PAYPAL_WEBHOOK_BODY_COMPRESSION is set.', null=True),
+        ),
+    ]
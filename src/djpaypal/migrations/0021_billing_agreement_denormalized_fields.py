@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0020_webhook_trigger_body_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingagreement',
+            name='cycles_completed',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='last_payment_date',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='next_billing_date',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='outstanding_balance',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='outstanding_balance_currency',
+            field=models.CharField(blank=True, editable=False, max_length=3),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='payer_email',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='regular_frequency',
+            field=models.CharField(blank=True, choices=[('DAY', 'Day'), ('MONTH', 'Month'), ('WEEK', 'Week'), ('YEAR', 'Year')], editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='billingagreement',
+            name='regular_frequency_interval',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0021_billing_agreement_denormalized_fields'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='billingagreement',
+            index=models.Index(fields=['user', 'plan_model', 'end_of_period', 'state'], name='djpaypal_ba_entitlement_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0022_billing_agreement_entitlement_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingplan',
+            name='price_summary',
+            field=models.CharField(blank=True, editable=False, max_length=128),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpaypal', '0023_billing_plan_price_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the processing of the trigger started (cleared once done).', null=True),
+        ),
+    ]
@@ -4,11 +4,11 @@ from .billing import (
 from .disputes import Dispute
 from .payer import Payer
 from .payments import Payment, Refund, Sale
-from .webhooks import WebhookEvent, WebhookEventTrigger
+from .webhooks import WebhookEvent, WebhookEventTrigger, WebhookHandlerJob
 
 
 __all__ = (
 	"BillingAgreement", "BillingPlan", "ChargeModel", "Dispute", "Payment",
 	"Payer", "PaymentDefinition", "PreparedBillingAgreement", "Refund", "Sale",
-	"WebhookEvent", "WebhookEventTrigger"
+	"WebhookEvent", "WebhookEventTrigger", "WebhookHandlerJob"
 )
@@ -1,20 +1,164 @@
-from django.db import models
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import timedelta
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, transaction
+from django.dispatch import Signal
 from django.urls import reverse
+from django.utils.timezone import now
+
+from .. import metrics
+from ..instrumentation import maybe_instrument
+from ..settings import (
+	PAYPAL_LIVE_MODE, PAYPAL_RESYNC_DEFERRED, PAYPAL_RESYNC_MAX_AGE, PAYPAL_SYNC_CONCURRENCY
+)
+
 
-from ..settings import PAYPAL_LIVE_MODE
+# Sent when a stale object should be refetched from the API, in deferred mode.
+# Provides arguments:
+# - id
+
+resync_requested = Signal()
 
 
 class PaypalObjectManager(models.Manager):
-	def sync_data(self, paypal_data, fetch=True):
-		ret = []
-		for obj in paypal_data:
+	def sync_data(self, paypal_data, fetch=True, bulk=False, concurrency=None):
+		"""
+		Sync a list of Paypal objects to the database.
+
+		If `fetch` is True, the full objects are first retrieved from the API,
+		using up to `concurrency` parallel requests (defaults to
+		settings.PAYPAL_SYNC_CONCURRENCY). Database writes always happen on
+		the calling thread.
+		If `bulk` is True, the objects are written using a constant number of
+		queries (see `bulk_sync_data()`) instead of one upsert per object.
+
+		Returns the list of model instances, in the same order as `paypal_data`.
+		"""
+		# Accept any iterable (eg. generators or paginated SDK results)
+		paypal_data = list(paypal_data)
+		metrics.sync_batch(self.model, len(paypal_data))
+		with maybe_instrument(sender=self.model, label="sync_data"):
 			if fetch:
-				api_full_data = self.model.paypal_model.find(obj["id"])
+				paypal_data = self.fetch_data(paypal_data, concurrency=concurrency)
+
+			if bulk:
+				return self.bulk_sync_data(paypal_data)
+
+			ret = []
+			for obj in paypal_data:
+				db_obj, _ = self.model.get_or_update_from_api_data(obj)
+				ret.append(db_obj)
+			return ret
+
+	def fetch_data(self, paypal_data, concurrency=None):
+		"""
+		Retrieve the full API objects for a list of (partial) Paypal objects.
+
+		Returns the objects in the same order as `paypal_data`.
+		"""
+		ids = [obj["id"] for obj in paypal_data]
+		if concurrency is None:
+			concurrency = PAYPAL_SYNC_CONCURRENCY
+		concurrency = min(concurrency, len(ids))
+		if concurrency <= 1:
+			return [self.model.paypal_model.find(id) for id in ids]
+
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			# Run each request in a copy of the current context, so that
+			# instrumentation records the API calls.
+			futures = [
+				executor.submit(copy_context().run, self.model.paypal_model.find, id)
+				for id in ids
+			]
+			return [future.result() for future in futures]
+
+	def bulk_sync_data(self, paypal_data):
+		"""
+		Bulk version of `get_or_update_from_api_data()`.
+
+		Existing objects are prefetched in a single query, new objects are
+		created with `bulk_create()` and changed objects are written with
+		`bulk_update()`. Many-to-many relations are inserted directly in
+		their through tables.
+
+		Note that `save()` is not called on the instances. Models which rely
+		on it should implement `prepare_bulk_save()`.
+		"""
+		id_field_name = self.model.id_field_name
+		cleaned = [self.model.clean_and_hash_api_data(obj) for obj in paypal_data]
+		# Duplicate objects in the input: the last version wins
+		latest = {id: (cleaned_data, m2ms) for id, cleaned_data, m2ms in cleaned}
+		existing = self.in_bulk(latest, field_name=id_field_name)
+
+		instances, to_create, to_update, update_fields = {}, {}, {}, set()
+		create_fields = {"djpaypal_data_hash", "djpaypal_updated"}
+		changed_m2ms = []
+		for id, (cleaned_data, m2ms) in latest.items():
+			if id in existing:
+				db_obj = instances[id] = existing[id]
+				if db_obj.djpaypal_data_hash == cleaned_data["djpaypal_data_hash"]:
+					continue
+				for k, v in cleaned_data.items():
+					if db_obj._sync_data_field(k, v):
+						update_fields.add(k)
+						to_update[id] = db_obj
 			else:
-				api_full_data = obj
-			db_obj, _ = self.model.get_or_update_from_api_data(api_full_data)
-			ret.append(db_obj)
-		return ret
+				instances[id] = to_create[id] = self.model(**{id_field_name: id}, **cleaned_data)
+				create_fields.update(cleaned_data)
+			changed_m2ms.append((instances[id], m2ms))
+
+		with transaction.atomic(using=self.db):
+			prepared_fields = self.model.prepare_bulk_save(
+				list(to_create.values()) + list(to_update.values())
+			)
+			self._bulk_create(to_create.values(), create_fields | prepared_fields)
+			if to_update:
+				timestamp = now()
+				for db_obj in to_update.values():
+					db_obj.djpaypal_updated = timestamp
+				self.bulk_update(
+					to_update.values(),
+					sorted(update_fields | prepared_fields | {"djpaypal_updated"})
+				)
+			self._bulk_add_m2ms(changed_m2ms)
+
+		return [instances[id] for id, _, _ in cleaned]
+
+	def _bulk_create(self, objs, fields):
+		if not objs:
+			return
+		features = connections[self.db].features
+		if getattr(features, "supports_update_conflicts_with_target", False):
+			# Upsert, in case the objects were created concurrently since we
+			# prefetched the existing ones. Only the fields set from the API data
+			# are updated, so that local fields (eg. user) are kept.
+			self.bulk_create(
+				objs, update_conflicts=True, unique_fields=[self.model._meta.pk.name],
+				update_fields=sorted(fields),
+			)
+		else:
+			self.bulk_create(objs)
+
+	def _bulk_add_m2ms(self, objs_m2ms):
+		through_objs = {}
+		for db_obj, m2ms in objs_m2ms:
+			for field_name, related_objs in m2ms.items():
+				field = self.model._meta.get_field(field_name)
+				through = field.remote_field.through
+				source = through._meta.get_field(field.m2m_field_name()).attname
+				target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+				through_objs.setdefault(through, []).extend(
+					through(**{source: db_obj.pk, target: related_obj.pk})
+					for related_obj in related_objs
+				)
+
+		for through, objs in through_objs.items():
+			through.objects.using(self.db).bulk_create(objs, ignore_conflicts=True)
 
 
 class PaypalObject(models.Model):
@@ -26,6 +170,10 @@ class PaypalObject(models.Model):
 
 	djpaypal_created = models.DateTimeField(auto_now_add=True)
 	djpaypal_updated = models.DateTimeField(auto_now=True)
+	djpaypal_data_hash = models.CharField(
+		max_length=64, blank=True, editable=False,
+		help_text="Hash of the API data the object was last synced from."
+	)
 
 	objects = PaypalObjectManager()
 
@@ -55,16 +203,54 @@ class PaypalObject(models.Model):
 
 		return id, cleaned_data, {}
 
+	@staticmethod
+	def get_data_hash(cleaned_data, m2ms):
+		"""
+		Returns a stable hash of the cleaned API data and many-to-many relations.
+		"""
+		data = dict(cleaned_data)
+		for field, objs in m2ms.items():
+			data[field] = sorted(obj.pk for obj in objs)
+		serialized = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder)
+		return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
 	@classmethod
-	def get_or_update_from_api_data(cls, data, always_sync=False):
+	def clean_and_hash_api_data(cls, data):
+		"""
+		Same as `clean_api_data()`, with the data hash added to the cleaned data.
+		"""
 		id, cleaned_data, m2ms = cls.clean_api_data(data)
+		cleaned_data["djpaypal_data_hash"] = cls.get_data_hash(cleaned_data, m2ms)
+		return id, cleaned_data, m2ms
+
+	@classmethod
+	def get_or_update_from_api_data(cls, data, always_sync=False):
+		"""
+		Create or update an object from API data.
+
+		Existing objects are left untouched if the data is identical to the
+		data they were last synced from.
+		"""
+		return cls.get_or_update_from_cleaned_data(
+			*cls.clean_and_hash_api_data(data), always_sync=always_sync
+		)
+
+	@classmethod
+	def get_or_update_from_cleaned_data(cls, id, cleaned_data, m2ms, always_sync=False):
+		"""
+		Same as `get_or_update_from_api_data()`, with data returned by
+		`clean_and_hash_api_data()`. Cleaning may call the API (eg. to refresh
+		related objects); this only writes to the database.
+		"""
 		db_obj, created = cls.objects.get_or_create(**{
 			cls.id_field_name: id,
 			"defaults": cleaned_data,
 		})
+		if not created and db_obj.djpaypal_data_hash == cleaned_data["djpaypal_data_hash"]:
+			return db_obj, created
+
 		if always_sync or not created:
 			db_obj.sync_data(cleaned_data)
-			db_obj.save()
 
 		for field, objs in m2ms.items():
 			for obj in objs:
@@ -72,12 +258,58 @@ class PaypalObject(models.Model):
 
 		return db_obj, created
 
+	@classmethod
+	def prepare_bulk_save(cls, objs):
+		"""
+		Called by `PaypalObjectManager.bulk_sync_data()` on the objects about
+		to be bulk created or updated, in place of `save()`.
+
+		Returns a set of additional field names modified on the objects.
+		"""
+		return set()
+
 	@classmethod
 	def find_and_sync(cls, id):
 		obj = cls.paypal_model.find(id)
 		db_obj, created = cls.get_or_update_from_api_data(obj, always_sync=True)
 		return db_obj
 
+	@classmethod
+	def find_and_sync_if_stale(
+		cls, id, max_age=PAYPAL_RESYNC_MAX_AGE, deferred=PAYPAL_RESYNC_DEFERRED
+	):
+		"""
+		Ensure that an object exists in the database and is reasonably fresh.
+
+		Objects missing from the database are always fetched. Existing objects
+		are refetched if they were last updated more than `max_age` seconds
+		ago (always, if `max_age` is None).
+		If `deferred` is True, stale objects are not refetched: the
+		`resync_requested` signal is sent instead, so that the refresh can be
+		queued.
+		"""
+		if max_age is None and not deferred:
+			return cls.find_and_sync(id)
+
+		db_obj = cls.objects.filter(**{cls.id_field_name: id}).first()
+		if db_obj is None:
+			return cls.find_and_sync(id)
+
+		threshold = now() - timedelta(seconds=max_age or 0)
+		if max_age is not None and db_obj.djpaypal_updated >= threshold:
+			return db_obj
+
+		if deferred:
+			resync_requested.send(sender=cls, id=id)
+			return db_obj
+
+		db_obj = cls.find_and_sync(id)
+		if db_obj.djpaypal_updated < threshold:
+			# The data did not change, but the object is now known to be fresh
+			db_obj.djpaypal_updated = now()
+			cls.objects.filter(pk=db_obj.pk).update(djpaypal_updated=db_obj.djpaypal_updated)
+		return db_obj
+
 	def __str__(self):
 		if hasattr(self, "name") and self.name:
 			return self.name
@@ -108,7 +340,20 @@ class PaypalObject(models.Model):
 		if k == "links":
 			return False
 
-		if getattr(self, k) != v:
+		current_value = getattr(self, k)
+		try:
+			field = self._meta.get_field(k)
+		except FieldDoesNotExist:
+			pass
+		else:
+			# Compare the python values (eg. API datetimes are strings)
+			try:
+				v = field.to_python(v)
+				current_value = field.to_python(current_value)
+			except ValidationError:
+				pass
+
+		if current_value != v:
 			setattr(self, k, v)
 			return True
 
@@ -118,11 +363,17 @@ class PaypalObject(models.Model):
 		return self.paypal_model.find(self.id)
 
 	def sync_data(self, obj):
+		"""
+		Update the instance with the API data in `obj`.
+
+		Only the fields that changed are saved. Nothing is written to the
+		database if the data is identical.
+		"""
 		obj = self.sdk_object_as_dict(obj)
-		updated = False
+		updated_fields = []
 		for k, v in obj.items():
 			if self._sync_data_field(k, v):
-				updated = True
+				updated_fields.append(k)
 
-		if updated:
-			self.save()
+		if updated_fields:
+			self.save(update_fields=updated_fields + ["djpaypal_updated"])
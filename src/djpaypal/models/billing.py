@@ -1,8 +1,13 @@
+import json
 import re
 from datetime import datetime
+from decimal import Decimal
+from functools import partial
 
 from dateutil.parser import parse
 from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models, transaction
 from django.utils.timezone import now
 from paypalrestsdk import payments as paypal_models
@@ -10,8 +15,10 @@ from paypalrestsdk import payments as paypal_models
 from .. import enums
 from ..exceptions import AgreementAlreadyExecuted, PaypalApiError
 from ..fields import CurrencyAmountField, JSONField
-from ..settings import PAYPAL_LIVE_MODE
-from .base import PaypalObject
+from ..settings import (
+	PAYPAL_ENTITLEMENT_CACHE, PAYPAL_ENTITLEMENT_CACHE_TIMEOUT, PAYPAL_LIVE_MODE
+)
+from .base import PaypalObject, PaypalObjectManager
 
 
 def get_frequency_delta(frequency, frequency_interval):
@@ -27,6 +34,23 @@ def get_frequency_delta(frequency, frequency_interval):
 	return relativedelta(**{frequency_kw: frequency_interval})
 
 
+# End of period of agreements which have never been paid
+EXPIRED_END_OF_PERIOD = parse("1970-01-01T00:00:00Z")
+
+
+class BillingPlanQuerySet(models.QuerySet):
+	def with_payment_definitions(self):
+		"""
+		Prefetch the payment definitions of the plans and their charge models,
+		so that listing plans takes a constant number of queries.
+		"""
+		return self.prefetch_related("payment_definitions__charge_models")
+
+
+class BillingPlanManager(PaypalObjectManager.from_queryset(BillingPlanQuerySet)):
+	pass
+
+
 class BillingPlan(PaypalObject):
 	name = models.CharField(max_length=128)
 	description = models.CharField(max_length=127)
@@ -38,6 +62,11 @@ class BillingPlan(PaypalObject):
 
 	payment_definitions = models.ManyToManyField("PaymentDefinition")
 
+	# Denormalized human_readable_price of the regular payment definition
+	price_summary = models.CharField(max_length=128, blank=True, editable=False)
+
+	objects = BillingPlanManager()
+
 	paypal_model = paypal_models.BillingPlan
 
 	@classmethod
@@ -47,6 +76,10 @@ class BillingPlan(PaypalObject):
 		pds = cleaned_data.pop("payment_definitions")
 		# Sync payment definitions but do not fetch them (we have them in full)
 		m2ms["payment_definitions"] = PaymentDefinition.objects.sync_data(pds, fetch=False)
+		cleaned_data["price_summary"] = next((
+			pd.human_readable_price for pd in m2ms["payment_definitions"]
+			if pd.type == enums.PaymentDefinitionType.REGULAR
+		), "")
 
 		return id, cleaned_data, m2ms
 
@@ -65,10 +98,22 @@ class BillingPlan(PaypalObject):
 
 	@property
 	def regular_payment_definition(self):
-		return self.payment_definitions.get(type=enums.PaymentDefinitionType.REGULAR)
+		if "payment_definitions" not in getattr(self, "_prefetched_objects_cache", {}):
+			return self.payment_definitions.get(type=enums.PaymentDefinitionType.REGULAR)
+
+		# Use the prefetched payment definitions (see with_payment_definitions())
+		for pd in self.payment_definitions.all():
+			if pd.type == enums.PaymentDefinitionType.REGULAR:
+				return pd
+		raise PaymentDefinition.DoesNotExist(
+			"%s has no regular payment definition" % (self)
+		)
 
 	@property
 	def human_readable_price(self):
+		if self.price_summary:
+			return self.price_summary
+
 		pd = self.regular_payment_definition
 		if pd:
 			return pd.human_readable_price
@@ -190,7 +235,76 @@ class PreparedBillingAgreement(models.Model):
 		return ret
 
 
+# Billing agreements in these states are entitled until their end of period.
+# Cancelled and suspended agreements were paid for until then.
+ENTITLED_STATES = (
+	enums.BillingAgreementState.Active,
+	enums.BillingAgreementState.Cancelled,
+	enums.BillingAgreementState.Reactivated,
+	enums.BillingAgreementState.Suspended,
+)
+
+
+def get_entitlement_cache_key(user_id):
+	return "djpaypal:entitlements:{}".format(user_id)
+
+
+def invalidate_entitlement_cache(*user_ids):
+	if PAYPAL_ENTITLEMENT_CACHE:
+		caches[PAYPAL_ENTITLEMENT_CACHE].delete_many([
+			get_entitlement_cache_key(user_id) for user_id in user_ids if user_id is not None
+		])
+
+
+class BillingAgreementManager(PaypalObjectManager):
+	def active_for(self, user, plan=None):
+		"""
+		Returns the billing agreements of the user (optionally for a plan)
+		which are entitled right now.
+		"""
+		qs = self.filter(user=user, end_of_period__gt=now(), state__in=ENTITLED_STATES)
+		if plan is not None:
+			qs = qs.filter(plan_model=plan)
+		return qs
+
+	def has_active(self, user, plan=None):
+		"""
+		Returns whether the user has an entitled billing agreement right
+		now (optionally for a plan).
+
+		If settings.PAYPAL_ENTITLEMENT_CACHE is set, the entitled agreements
+		of the user are cached until one of their billing agreements changes.
+		"""
+		if not PAYPAL_ENTITLEMENT_CACHE:
+			return self.active_for(user, plan).exists()
+
+		cache = caches[PAYPAL_ENTITLEMENT_CACHE]
+		key = get_entitlement_cache_key(user.pk)
+		entitlements = cache.get(key)
+		if entitlements is None:
+			entitlements = list(
+				self.active_for(user).values_list("plan_model_id", "end_of_period")
+			)
+			cache.set(key, entitlements, timeout=PAYPAL_ENTITLEMENT_CACHE_TIMEOUT)
+
+		current_time = now()
+		plan_id = getattr(plan, "pk", plan)
+		return any(
+			end_of_period > current_time and (plan_id is None or plan_model_id == plan_id)
+			for plan_model_id, end_of_period in entitlements
+		)
+
+
 class BillingAgreement(PaypalObject):
+	class Meta:
+		indexes = [
+			# Entitlement lookups (BillingAgreement.objects.active_for())
+			models.Index(
+				fields=["user", "plan_model", "end_of_period", "state"],
+				name="djpaypal_ba_entitlement_idx",
+			),
+		]
+
 	name = models.CharField(max_length=128, blank=True)
 	state = models.CharField(
 		max_length=128, editable=False, choices=enums.BillingAgreementState.choices
@@ -216,6 +330,29 @@ class BillingAgreement(PaypalObject):
 	)
 	end_of_period = models.DateTimeField(db_index=True)
 
+	# Denormalized from agreement_details, payer and plan (see get_denormalized_data)
+	last_payment_date = models.DateTimeField(
+		null=True, blank=True, db_index=True, editable=False
+	)
+	next_billing_date = models.DateTimeField(
+		null=True, blank=True, db_index=True, editable=False
+	)
+	outstanding_balance = models.DecimalField(
+		max_digits=12, decimal_places=2, null=True, blank=True, editable=False
+	)
+	outstanding_balance_currency = models.CharField(max_length=3, blank=True, editable=False)
+	cycles_completed = models.PositiveIntegerField(null=True, blank=True, editable=False)
+	payer_email = models.CharField(max_length=254, blank=True, db_index=True, editable=False)
+	regular_frequency = models.CharField(
+		max_length=20, blank=True, editable=False,
+		choices=enums.PaymentDefinitionFrequency.choices
+	)
+	regular_frequency_interval = models.PositiveSmallIntegerField(
+		null=True, blank=True, editable=False
+	)
+
+	objects = BillingAgreementManager()
+
 	paypal_model = paypal_models.BillingAgreement
 	dashboard_url_template = (
 		"{webscr}?cmd=_profile-recurring-payments&encrypted_profile_id={id}"
@@ -229,8 +366,45 @@ class BillingAgreement(PaypalObject):
 		if "state" in cleaned_data and cleaned_data["state"].lower() == "canceled":
 			cleaned_data["state"] = enums.BillingAgreementState.Cancelled
 
+		cleaned_data.update(cls.get_denormalized_data(cleaned_data))
+
 		return id, cleaned_data, m2ms
 
+	@staticmethod
+	def get_denormalized_data(data):
+		"""
+		Extract the values of the denormalized fields from the
+		agreement_details, payer and plan of the API data.
+		"""
+		details = data.get("agreement_details") or {}
+		payer_info = (data.get("payer") or {}).get("payer_info") or {}
+		outstanding_balance = details.get("outstanding_balance") or {}
+		cycles_completed = details.get("cycles_completed")
+
+		ret = {
+			"last_payment_date": None,
+			"next_billing_date": None,
+			"outstanding_balance": None,
+			"outstanding_balance_currency": outstanding_balance.get("currency", ""),
+			"cycles_completed": int(cycles_completed) if cycles_completed else None,
+			"payer_email": payer_info.get("email", ""),
+			"regular_frequency": "",
+			"regular_frequency_interval": None,
+		}
+		for field in "last_payment_date", "next_billing_date":
+			if details.get(field):
+				ret[field] = parse(details[field])
+		if outstanding_balance.get("value"):
+			ret["outstanding_balance"] = Decimal(outstanding_balance["value"])
+
+		for pd in (data.get("plan") or {}).get("payment_definitions", []):
+			if pd.get("type") == enums.PaymentDefinitionType.REGULAR:
+				ret["regular_frequency"] = pd["frequency"].upper()
+				ret["regular_frequency_interval"] = int(pd["frequency_interval"])
+				break
+
+		return ret
+
 	@classmethod
 	def execute(cls, token):
 		if not token:
@@ -243,22 +417,128 @@ class BillingAgreement(PaypalObject):
 		obj, created = cls.get_or_update_from_api_data(ba, always_sync=True)
 		return obj
 
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance = super().from_db(db, field_names, values)
+		if not {"payer", "user_id", "livemode"}.difference(field_names):
+			# Remember what the payer was last upserted from
+			instance._payer_state = instance._get_payer_state()
+		if "user_id" in field_names:
+			# The entitlements of the previous user are invalidated too
+			instance._loaded_user_id = instance.user_id
+		return instance
+
+	def _get_entitlement_user_ids(self):
+		return {getattr(self, "_loaded_user_id", None), self.user_id}
+
+	@classmethod
+	def prepare_bulk_save(cls, objs):
+		cls._bulk_update_payer_models(objs)
+		for obj in objs:
+			obj._update_end_of_period()
+		transaction.on_commit(partial(
+			invalidate_entitlement_cache,
+			*set().union(*(obj._get_entitlement_user_ids() for obj in objs))
+		))
+		return {"payer_model", "end_of_period"}
+
 	def save(self, **kwargs):
+		self._update_payer_model()
+		self._update_end_of_period()
+
+		if kwargs.get("update_fields") is not None:
+			kwargs["update_fields"] = set(kwargs["update_fields"]) | {
+				"payer_model", "end_of_period"
+			}
+
+		ret = super().save(**kwargs)
+		# After the write: in autocommit mode, the callback runs immediately
+		transaction.on_commit(partial(
+			invalidate_entitlement_cache, *self._get_entitlement_user_ids()
+		))
+		self._loaded_user_id = self.user_id
+		return ret
+
+	def _get_payer_state(self):
+		payer_info = self.payer.get("payer_info", {})
+		if not payer_info or "payer_id" not in payer_info:
+			return None
+		return json.dumps(
+			[payer_info, self.user_id, self.livemode], sort_keys=True, cls=DjangoJSONEncoder
+		)
+
+	def _get_payer_defaults(self):
+		# Copy the payer_info dict before mutating it
+		payer_info = self.payer["payer_info"].copy()
+		payer_id = payer_info.pop("payer_id")
+		payer_info["user_id"] = self.user_id
+		payer_info["livemode"] = self.livemode
+		return payer_id, payer_info
+
+	def _payer_model_changed(self):
+		"""
+		Returns the current payer state if the Payer needs to be upserted,
+		or None if there is no payer info or it did not change since the
+		payer was last upserted.
+		"""
+		payer_state = self._get_payer_state()
+		if payer_state is None:
+			return None
+		if self.payer_model_id and payer_state == getattr(self, "_payer_state", None):
+			return None
+		return payer_state
+
+	def _update_payer_model(self):
 		from .payer import Payer
 
-		# On save, get the payer_info object and do a best effort attempt at
+		# Get the payer_info object and do a best effort attempt at
 		# saving a Payer model and relation into the db.
-		payer_info = self.payer.get("payer_info", {})
-		if payer_info and "payer_id" in payer_info:
-			# Copy the payer_info dict before mutating it
-			payer_info = payer_info.copy()
-			payer_id = payer_info.pop("payer_id")
-			payer_info["user"] = self.user
-			payer_info["livemode"] = self.livemode
+		payer_state = self._payer_model_changed()
+		if payer_state is not None:
+			payer_id, defaults = self._get_payer_defaults()
 			self.payer_model, created = Payer.objects.update_or_create(
-				id=payer_id, defaults=payer_info
+				id=payer_id, defaults=defaults
 			)
+			self._payer_state = payer_state
 
+	@classmethod
+	def _bulk_update_payer_models(cls, objs):
+		"""
+		Bulk version of `_update_payer_model()`: upsert the changed Payers of
+		the billing agreements with a constant number of queries.
+		"""
+		from .payer import Payer
+
+		changed = [(obj, obj._payer_model_changed()) for obj in objs]
+		changed = [(obj, payer_state) for obj, payer_state in changed if payer_state is not None]
+		if not changed:
+			return
+
+		# The last billing agreement of a payer wins, as with save()
+		payers = dict(obj._get_payer_defaults() for obj, _ in changed)
+		existing = Payer.objects.in_bulk(payers)
+		to_create, to_update, update_fields = [], [], {"djpaypal_updated"}
+		timestamp = now()
+		for payer_id, defaults in payers.items():
+			if payer_id in existing:
+				payer = existing[payer_id]
+				for k, v in defaults.items():
+					setattr(payer, k, v)
+				payer.djpaypal_updated = timestamp
+				update_fields.update(defaults)
+				to_update.append(payer)
+			else:
+				to_create.append(Payer(id=payer_id, **defaults))
+
+		# Payers created concurrently since they were prefetched are left as is
+		Payer.objects.bulk_create(to_create, ignore_conflicts=True)
+		Payer.objects.bulk_update(to_update, sorted(update_fields))
+
+		for obj, payer_state in changed:
+			obj.payer_model_id = obj.payer["payer_info"]["payer_id"]
+			obj._payer_state = payer_state
+
+	def _update_end_of_period(self):
 		# Do not overwrite the end of period for cancelled subscriptions
 		if (
 			self.state != enums.BillingAgreementState.Cancelled or
@@ -266,8 +546,6 @@ class BillingAgreement(PaypalObject):
 		):
 			self.end_of_period = self.calculate_end_of_period()
 
-		return super().save(**kwargs)
-
 	def cancel(self, note, immediately=False):
 		obj = self.find_paypal_object()
 		obj.cancel({"note": note})
@@ -285,28 +563,24 @@ class BillingAgreement(PaypalObject):
 		obj = self.find_and_sync(self.id)
 		return obj
 
-	@property
-	def last_payment_date(self):
-		date = self.agreement_details.get("last_payment_date", "")
-		if date:
-			return parse(date)
-
 	def calculate_end_of_period(self):
 		# The next payment date is not reliably set.
 		# When a subscription is cancelled, we do not have access to it anymore...
 		# So instead, keep the end_of_period attribute up to date.
 		last_payment_date = self.last_payment_date
-		if not last_payment_date:
-			return parse("1970-01-01T00:00:00Z")
-
-		rpd = next(filter(
-			lambda pd: pd["type"] == enums.PaymentDefinitionType.REGULAR,
-			self.plan["payment_definitions"]
-		))
+		frequency, interval = self.regular_frequency, self.regular_frequency_interval
+		if not frequency:
+			# The denormalized fields have not been backfilled yet
+			data = self.get_denormalized_data({
+				"agreement_details": self.agreement_details, "plan": self.plan
+			})
+			last_payment_date = data["last_payment_date"]
+			frequency, interval = data["regular_frequency"], data["regular_frequency_interval"]
 
-		delta = get_frequency_delta(rpd["frequency"], int(rpd["frequency_interval"]))
+		if not last_payment_date or not frequency:
+			return EXPIRED_END_OF_PERIOD
 
-		return last_payment_date + delta
+		return last_payment_date + get_frequency_delta(frequency, interval)
 
 
 class PaymentDefinition(PaypalObject):
@@ -338,7 +612,7 @@ class PaymentDefinition(PaypalObject):
 		from ..utils import get_friendly_currency_amount
 
 		amount = get_friendly_currency_amount(self.amount["value"], self.amount["currency"])
-		interval_count = self.frequency_interval
+		interval_count = int(self.frequency_interval)
 
 		if interval_count == 1:
 			interval = self.frequency.lower()
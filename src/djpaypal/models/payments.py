@@ -104,8 +104,8 @@ class Refund(PaypalObject):
 		if "sale_id" in cleaned_data:
 			sale_id = cleaned_data["sale_id"]
 			# Ensure that the refunded sale exists in the db
-			# If it exists, it will be updated with new data
-			Sale.find_and_sync(sale_id)
+			# If it is stale, it will be updated with new data
+			Sale.find_and_sync_if_stale(sale_id)
 
 		return id, cleaned_data, m2ms
 
@@ -161,8 +161,8 @@ class Sale(PaypalObject):
 		if "billing_agreement_id" in cleaned_data:
 			ba_id = cleaned_data["billing_agreement_id"]
 			# Ensure that the billing agreement exists in the db
-			# If it exists, it will be updated with new data
-			BillingAgreement.find_and_sync(ba_id)
+			# If it is stale, it will be updated with new data
+			BillingAgreement.find_and_sync_if_stale(ba_id)
 
 		# Ensure the parent payment exists in the db
 		if "parent_payment" in cleaned_data:
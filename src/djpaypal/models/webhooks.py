@@ -1,16 +1,33 @@
 import json
-from fnmatch import fnmatch
+import time
+from datetime import timedelta
+from functools import partial
 from traceback import format_exc
 
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, close_old_connections, models, transaction
+from django.db.models import Q
 from django.dispatch import Signal
 from django.utils.functional import cached_property
+from django.utils.timezone import now
 from paypalrestsdk import notifications as paypal_models
 
+from .. import enums, metrics
+from ..dispatch import (
+	ASYNC, DEFERRED, SYNC, get_executor, get_receiver_name, webhook_dispatcher
+)
 from ..fields import JSONField
-from ..settings import PAYPAL_WEBHOOK_ID
-from ..utils import fix_django_headers, get_version
+from ..instrumentation import maybe_instrument
+from ..settings import (
+	PAYPAL_WEBHOOK_BODY_COMPRESSION, PAYPAL_WEBHOOK_CLAIM_TIMEOUT,
+	PAYPAL_WEBHOOK_DEFERRED, PAYPAL_WEBHOOK_ID
+)
+from ..utils import compress, decompress, fix_django_headers, get_version
+from ..verification import verify_webhook
 from .base import PaypalObject
+from .billing import BillingAgreement, BillingPlan
+from .disputes import Dispute
+from .payments import Refund, Sale
 
 
 WEBHOOK_EVENT_TYPES = {
@@ -69,12 +86,59 @@ WEBHOOK_SIGNALS = {
 	hook: Signal() for hook in WEBHOOK_EVENT_TYPES
 }
 
+# Paypal sends event types in uppercase; index both forms so that
+# dispatching an event is a single lookup.
+_WEBHOOK_SIGNAL_LOOKUP = {
+	**WEBHOOK_SIGNALS,
+	**{event_type.upper(): signal for event_type, signal in WEBHOOK_SIGNALS.items()},
+}
+
+# Maps the (lowercase) resource_type of webhook events to the model
+# the resource is synced to.
+
+WEBHOOK_RESOURCE_MODELS = {
+	"agreement": BillingAgreement,
+	"dispute": Dispute,
+	"plan": BillingPlan,
+	"refund": Refund,
+	"sale": Sale,
+}
+
+# Event types whose resource is not synced to any model.
+# Entries ending with ".*" match all the event types with that prefix.
+
+WEBHOOK_UNSYNCED_EVENT_TYPES = {
+	# risk.dispute.* events are a different kind of dispute object.
+	# Also, who the **** knows what these objects actually are.
+	# TODO: Get/Create the actual dispute object.
+	# Depends on SDK implementation which is currently missing:
+	# https://github.com/paypal/PayPal-Python-SDK/issues/216
+	"risk.dispute.*",
+}
+
 # Provides arguments:
 # - exception
 
 webhook_error = Signal()
 
 
+def get_resource_model(resource_type):
+	try:
+		return WEBHOOK_RESOURCE_MODELS[resource_type.lower()]
+	except KeyError:
+		raise NotImplementedError("Unimplemented webhook resource: %r" % (resource_type))
+
+
+def is_synced_event_type(event_type):
+	event_type = event_type.lower()
+	return not any(
+		event_type == unsynced or (
+			unsynced.endswith(".*") and event_type.startswith(unsynced[:-1])
+		)
+		for unsynced in WEBHOOK_UNSYNCED_EVENT_TYPES
+	)
+
+
 class WebhookEvent(PaypalObject):
 	event_version = models.CharField(max_length=8, editable=False)
 	create_time = models.DateTimeField(db_index=True, editable=False)
@@ -92,31 +156,36 @@ class WebhookEvent(PaypalObject):
 
 	@classmethod
 	def process(cls, data):
-		ret, created = cls.get_or_update_from_api_data(data)
-		ret.create_or_update_resource()
+		"""
+		Sync the event and its resource, and send the event signal if the
+		event is new.
+
+		The API data is cleaned first, outside of a transaction, since
+		cleaning the resource may refresh related objects from the API.
+		Only the database writes (and the async and deferred handler jobs)
+		are done in a transaction; the signal and sync handlers are called
+		once it is committed, so that they do not hold its locks and an
+		exception they raise does not roll back the event.
+		"""
+		id, cleaned_data, m2ms = cls.clean_and_hash_api_data(data)
+		resource_model, resource_data = None, None
+		if is_synced_event_type(cleaned_data["event_type"]):
+			resource_model = get_resource_model(cleaned_data["resource_type"])
+			resource_data = resource_model.clean_and_hash_api_data(cleaned_data["resource"])
+
+		with transaction.atomic():
+			ret, created = cls.get_or_update_from_cleaned_data(id, cleaned_data, m2ms)
+			if resource_model is not None:
+				resource_model.get_or_update_from_cleaned_data(*resource_data)
+			if created:
+				ret.schedule_handlers()
 		if created:
 			ret.send_signal()
 		return ret
 
 	@property
 	def resource_model(self):
-		resource_type = self.resource_type.lower()
-		if resource_type == "agreement":
-			from .billing import BillingAgreement
-			return BillingAgreement
-		elif resource_type == "dispute":
-			from .disputes import Dispute
-			return Dispute
-		elif resource_type == "plan":
-			from .billing import BillingPlan
-			return BillingPlan
-		elif resource_type == "refund":
-			from .payments import Refund
-			return Refund
-		if resource_type == "sale":
-			from .payments import Sale
-			return Sale
-		raise NotImplementedError("Unimplemented webhook resource: %r" % (self.resource_type))
+		return get_resource_model(self.resource_type)
 
 	@property
 	def resource_id(self):
@@ -124,12 +193,7 @@ class WebhookEvent(PaypalObject):
 		return self.resource[cls.id_field_name]
 
 	def create_or_update_resource(self):
-		if self.event_type.lower().startswith("risk.dispute."):
-			# risk.dispute.* events are a different kind of dispute object.
-			# Also, who the **** knows what these objects actually are.
-			# TODO: Get/Create the actual dispute object.
-			# Depends on SDK implementation which is currently missing:
-			# https://github.com/paypal/PayPal-Python-SDK/issues/216
+		if not is_synced_event_type(self.event_type):
 			return
 
 		model = self.resource_model
@@ -139,12 +203,39 @@ class WebhookEvent(PaypalObject):
 		cls = self.resource_model
 		return cls.objects.get(**{cls.id_field_name: self.resource_id})
 
+	@property
+	def signal(self):
+		"""
+		The signal of the event type in WEBHOOK_SIGNALS (None if unknown).
+		"""
+		signal = _WEBHOOK_SIGNAL_LOOKUP.get(self.event_type)
+		if signal is None:
+			signal = _WEBHOOK_SIGNAL_LOOKUP.get(self.event_type.lower())
+		return signal
+
 	def send_signal(self):
-		event_type = self.event_type.lower()
-		signal = WEBHOOK_SIGNALS.get(event_type)
+		"""
+		Send the event signal, and call the sync handlers.
+		"""
+		signal = self.signal
 		if signal:
 			signal.send(sender=self.__class__, event=self)
 
+		# Handlers connected with webhook_handler() are called with the same
+		# arguments as signal receivers
+		for receiver in webhook_dispatcher.get_receivers(self.event_type):
+			if webhook_dispatcher.get_mode(receiver) == SYNC:
+				receiver(signal=signal, sender=self.__class__, event=self)
+
+	def schedule_handlers(self):
+		"""
+		Create the jobs of the async and deferred handlers.
+		"""
+		for receiver in webhook_dispatcher.get_receivers(self.event_type):
+			mode = webhook_dispatcher.get_mode(receiver)
+			if mode != SYNC:
+				WebhookHandlerJob.schedule(self, receiver, run_async=mode == ASYNC)
+
 
 class WebhookEventTrigger(models.Model):
 	id = models.BigAutoField(primary_key=True)
@@ -152,9 +243,25 @@ class WebhookEventTrigger(models.Model):
 		help_text="IP address of the request client."
 	)
 	headers = JSONField()
+	transmission_id = models.CharField(
+		max_length=128, unique=True, null=True, blank=True, editable=False,
+		help_text="The paypal-transmission-id header, unique to each webhook delivered."
+	)
 	body = models.TextField(blank=True)
+	body_compressed = models.BinaryField(
+		null=True, blank=True, editable=False,
+		help_text="The compressed body, if settings.PAYPAL_WEBHOOK_BODY_COMPRESSION is set."
+	)
 	valid = models.BooleanField(default=False)
 	processed = models.BooleanField(default=False)
+	pending = models.BooleanField(
+		default=False, db_index=True,
+		help_text="Whether the trigger is waiting to be verified and processed (deferred mode)."
+	)
+	claimed_at = models.DateTimeField(
+		null=True, blank=True, editable=False,
+		help_text="When the processing of the trigger started (cleared once done)."
+	)
 	exception = models.CharField(max_length=128, blank=True)
 	traceback = models.TextField(blank=True)
 	webhook_event = models.ForeignKey(
@@ -165,11 +272,25 @@ class WebhookEventTrigger(models.Model):
 		default=get_version,
 		help_text="The version of dj-paypal when the webhook was received"
 	)
+	processing_ms = models.PositiveIntegerField(
+		null=True, blank=True,
+		help_text="How long processing the webhook took, in milliseconds (instrumentation)."
+	)
+	api_calls = models.PositiveIntegerField(
+		null=True, blank=True,
+		help_text="Number of Paypal API calls made while processing the webhook."
+	)
+	db_queries = models.PositiveIntegerField(
+		null=True, blank=True,
+		help_text="Number of database queries made while processing the webhook."
+	)
 	created = models.DateTimeField(auto_now_add=True)
 	updated = models.DateTimeField(auto_now=True)
 
 	@classmethod
-	def from_request(cls, request, webhook_id=PAYPAL_WEBHOOK_ID):
+	def from_request(
+		cls, request, webhook_id=PAYPAL_WEBHOOK_ID, deferred=PAYPAL_WEBHOOK_DEFERRED
+	):
 		"""
 		Create, validate and process a WebhookEventTrigger given a Django
 		request object.
@@ -182,39 +303,195 @@ class WebhookEventTrigger(models.Model):
 		1. Create a WebhookEventTrigger object from a Django request.
 		2. Verify the WebhookEventTrigger as a Paypal webhook using the SDK.
 		3. If valid, process it into a WebhookEvent object (and child resource).
+
+		If deferred is True (defaults to settings.PAYPAL_WEBHOOK_DEFERRED),
+		only the first step is done and the trigger is marked as pending.
+		Pending triggers are verified and processed by `process_pending()`.
+
+		Paypal retries deliveries with the same transmission id. If the
+		webhook was already received, the original trigger is returned
+		without being processed again, unless it previously failed (see
+		`get_failed_q()`). Triggers being processed are marked with
+		`claimed_at`, so that concurrent deliveries are not processed twice.
 		"""
 
+		headers, transmission_id = cls._get_request_headers(request)
+
+		obj = None
+		if transmission_id:
+			obj = cls.objects.filter(transmission_id=transmission_id).first()
+
+		if obj is None:
+			try:
+				fields, data = cls._get_request_fields(
+					request, headers, transmission_id, pending=deferred
+				)
+				with transaction.atomic():
+					obj = cls.objects.create(**fields)
+				# The body was already parsed, do not parse it again
+				obj.data = data
+			except IntegrityError:
+				# The same webhook is being delivered concurrently, and is
+				# either pending or being processed
+				return cls.objects.get(transmission_id=transmission_id)
+		else:
+			retry_fields = cls._get_retry_fields(deferred)
+			if not cls.objects.filter(cls.get_failed_q(), pk=obj.pk).update(**retry_fields):
+				# Duplicate delivery of a webhook which was already handled,
+				# or which is being handled
+				obj.refresh_from_db()
+				return obj
+			# Retry of a webhook which previously failed
+			for k, v in retry_fields.items():
+				setattr(obj, k, v)
+
+		if not deferred:
+			obj.verify_and_process(webhook_id)
+
+		return obj
+
+	@classmethod
+	async def afrom_request(
+		cls, request, webhook_id=PAYPAL_WEBHOOK_ID, deferred=PAYPAL_WEBHOOK_DEFERRED
+	):
+		"""
+		Async version of `from_request()`, using the async ORM.
+
+		In deferred mode, storing the trigger does not block the event loop.
+		Otherwise, verifying and processing it (which makes blocking API
+		calls and runs in a transaction) is done in a worker thread.
+		"""
+		headers, transmission_id = cls._get_request_headers(request)
+
+		obj = None
+		if transmission_id:
+			obj = await cls.objects.filter(transmission_id=transmission_id).afirst()
+
+		if obj is None:
+			try:
+				fields, data = cls._get_request_fields(
+					request, headers, transmission_id, pending=deferred
+				)
+				obj = await cls.objects.acreate(**fields)
+				obj.data = data
+			except IntegrityError:
+				# The same webhook is being delivered concurrently, and is
+				# either pending or being processed
+				return await cls.objects.aget(transmission_id=transmission_id)
+		else:
+			retry_fields = cls._get_retry_fields(deferred)
+			updated = await cls.objects.filter(cls.get_failed_q(), pk=obj.pk).aupdate(
+				**retry_fields
+			)
+			if not updated:
+				# Duplicate delivery of a webhook which was already handled,
+				# or which is being handled
+				await sync_to_async(obj.refresh_from_db)()
+				return obj
+			# Retry of a webhook which previously failed
+			for k, v in retry_fields.items():
+				setattr(obj, k, v)
+
+		if not deferred:
+			await sync_to_async(obj.verify_and_process)(webhook_id)
+
+		return obj
+
+	@staticmethod
+	def get_failed_q():
+		"""
+		Triggers which were verified and processed, and failed (exception or
+		invalid signature), or whose processing was abandoned more than
+		settings.PAYPAL_WEBHOOK_CLAIM_TIMEOUT seconds ago.
+		"""
+		stale = now() - timedelta(seconds=PAYPAL_WEBHOOK_CLAIM_TIMEOUT)
+		return Q(processed=False, pending=False) & (
+			Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale)
+		)
+
+	@staticmethod
+	def _get_retry_fields(deferred):
+		# Deferred triggers are claimed by process_pending(), the other ones
+		# are being processed right away.
+		return {"pending": deferred, "claimed_at": None if deferred else now()}
+
+	@staticmethod
+	def _get_request_headers(request):
 		headers = fix_django_headers(request.META)
 		assert headers
+		return headers, headers.get("paypal-transmission-id") or None
+
+	@staticmethod
+	def _get_request_fields(request, headers, transmission_id, pending):
+		"""
+		Return the fields of a new trigger for the request, and the parsed body.
+		"""
 		try:
 			body = request.body.decode(request.encoding or "utf-8")
 		except Exception:
 			body = "(error decoding body)"
 
-		ip = request.META["REMOTE_ADDR"]
-		obj = cls.objects.create(headers=headers, body=body, remote_ip=ip)
+		fields = {
+			"headers": headers,
+			"transmission_id": transmission_id,
+			"remote_ip": request.META["REMOTE_ADDR"],
+			"pending": pending,
+			"claimed_at": None if pending else now(),
+		}
+		if PAYPAL_WEBHOOK_BODY_COMPRESSION:
+			fields["body_compressed"] = compress(
+				body.encode("utf-8"), PAYPAL_WEBHOOK_BODY_COMPRESSION
+			)
+		else:
+			fields["body"] = body
 
-		try:
-			obj.valid = obj.verify(PAYPAL_WEBHOOK_ID)
-			if obj.valid:
-				# Process the item (do not save it, it'll get saved below)
-				obj.process(save=False)
-		except Exception as e:
-			max_length = WebhookEventTrigger._meta.get_field("exception").max_length
-			obj.exception = str(e)[:max_length]
-			obj.traceback = format_exc()
-			webhook_error.send(sender=obj, exception=e)
-		finally:
-			obj.save()
+		return fields, parse_body(body)
 
-		return obj
+	@classmethod
+	def process_pending(cls, batch_size=100, webhook_id=PAYPAL_WEBHOOK_ID):
+		"""
+		Claim a batch of pending triggers, then verify and process them.
+
+		Triggers are claimed in a short transaction, locking them with
+		SELECT ... FOR UPDATE SKIP LOCKED, so that several workers can run
+		concurrently without processing the same trigger twice. They are
+		then verified and processed one by one, outside of that transaction.
+		Triggers claimed more than settings.PAYPAL_WEBHOOK_CLAIM_TIMEOUT
+		seconds ago (by a worker which died) are claimed again.
+
+		Returns the list of processed triggers (empty if none were pending).
+		"""
+		claimed_at = now()
+		stale = claimed_at - timedelta(seconds=PAYPAL_WEBHOOK_CLAIM_TIMEOUT)
+		with transaction.atomic():
+			triggers = list(
+				cls.objects.select_for_update(skip_locked=True)
+				.filter(pending=True)
+				.filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale))
+				.order_by("id")[:batch_size]
+			)
+			cls.objects.filter(pk__in=[trigger.pk for trigger in triggers]).update(
+				claimed_at=claimed_at
+			)
+
+		for trigger in triggers:
+			trigger.claimed_at = claimed_at
+			trigger.verify_and_process(webhook_id)
+
+		return triggers
+
+	@property
+	def raw_body(self):
+		"""
+		The body of the webhook, decompressed if it is stored compressed.
+		"""
+		if self.body_compressed:
+			return decompress(self.body_compressed).decode("utf-8")
+		return self.body
 
 	@cached_property
 	def data(self):
-		try:
-			return json.loads(self.body)
-		except ValueError:
-			return {}
+		return parse_body(self.raw_body)
 
 	@property
 	def auth_algo(self):
@@ -224,10 +501,6 @@ class WebhookEventTrigger(models.Model):
 	def cert_url(self):
 		return self.headers.get("paypal-cert-url", "")
 
-	@property
-	def transmission_id(self):
-		return self.headers.get("paypal-transmission-id", "")
-
 	@property
 	def transmission_sig(self):
 		return self.headers.get("paypal-transmission-sig", "")
@@ -236,19 +509,95 @@ class WebhookEventTrigger(models.Model):
 	def transmission_time(self):
 		return self.headers.get("paypal-transmission-time", "")
 
+	@property
+	def event_type(self):
+		data = self.data
+		return data.get("event_type", "") if isinstance(data, dict) else ""
+
 	def verify(self, webhook_id):
-		return paypal_models.WebhookEvent.verify(
-			transmission_id=self.transmission_id,
+		start = time.perf_counter()
+		valid = verify_webhook(
+			# Not the transmission_id column, which is NULL for duplicate deliveries
+			# stored before it existed
+			transmission_id=self.headers.get("paypal-transmission-id", ""),
 			timestamp=self.transmission_time,
 			webhook_id=webhook_id,
-			event_body=self.body,
+			event_body=self.raw_body,
 			cert_url=self.cert_url,
 			actual_sig=self.transmission_sig,
 			auth_algo=self.auth_algo,
 		)
+		metrics.webhook_verified(self, valid, time.perf_counter() - start)
+		return valid
+
+	def verify_and_process(self, webhook_id=PAYPAL_WEBHOOK_ID):
+		"""
+		Verify the trigger and, if valid, process it.
+
+		Exceptions are recorded on the trigger instead of being raised.
+		The trigger is always saved.
+		"""
+		self.exception = ""
+		self.traceback = ""
+		try:
+			# Verification makes network requests, do not hold a transaction open.
+			# The writes of WebhookEvent.process() are done in a transaction.
+			self.valid = self.verify(webhook_id)
+			if self.valid:
+				# Process the item (do not save it, it'll get saved below)
+				self.process(save=False)
+		except Exception as e:
+			self.record_exception(e)
+		finally:
+			self.pending = False
+			self.claimed_at = None
+			self.save()
+
+	@property
+	def processing(self):
+		"""
+		Whether the trigger is being verified and processed right now.
+		"""
+		return self.claimed_at is not None and not self.processed
+
+	def reprocess(self):
+		"""
+		Process the trigger again, recording any exception instead of raising it.
+		The trigger is always saved.
+
+		Returns True if the trigger was processed successfully.
+		"""
+		try:
+			self.process(save=False)
+		except Exception as e:
+			self.record_exception(e)
+		finally:
+			self.save()
+
+		return self.processed
+
+	def record_exception(self, exception):
+		max_length = WebhookEventTrigger._meta.get_field("exception").max_length
+		self.exception = str(exception)[:max_length]
+		self.traceback = format_exc()
+		metrics.webhook_failed(self)
+		webhook_error.send(sender=self, exception=exception)
+
+	def record_stats(self, stats):
+		self.processing_ms = stats.duration_ms
+		self.api_calls = stats.api_calls
+		self.db_queries = stats.db_queries
 
 	def process(self, save=True):
-		self.webhook_event = WebhookEvent.process(self.data)
+		stats = None
+		start = time.perf_counter()
+		try:
+			with maybe_instrument(sender=self.__class__, label=self.event_type) as stats:
+				self.webhook_event = WebhookEvent.process(self.data)
+		finally:
+			if stats is not None:
+				self.record_stats(stats)
+		metrics.webhook_processed(self, time.perf_counter() - start)
 		self.processed = True
 		self.exception = ""
 		self.traceback = ""
@@ -258,7 +607,141 @@ class WebhookEventTrigger(models.Model):
 		return self.webhook_event
 
 
-def webhook_handler(*event_types):
+class WebhookHandlerJob(models.Model):
+	"""
+	An execution of an async or deferred webhook handler for a webhook event.
+	"""
+	id = models.BigAutoField(primary_key=True)
+	webhook_event = models.ForeignKey("WebhookEvent", on_delete=models.CASCADE)
+	handler = models.CharField(
+		max_length=255, help_text="Dotted path of the handler function."
+	)
+	status = models.CharField(
+		max_length=16, choices=enums.WebhookHandlerJobStatus.choices,
+		default=enums.WebhookHandlerJobStatus.pending, db_index=True
+	)
+	started = models.DateTimeField(null=True, blank=True)
+	duration_ms = models.PositiveIntegerField(
+		null=True, blank=True, help_text="How long the handler ran for, in milliseconds."
+	)
+	exception = models.CharField(max_length=128, blank=True)
+	traceback = models.TextField(blank=True)
+	created = models.DateTimeField(auto_now_add=True)
+	updated = models.DateTimeField(auto_now=True)
+
+	def __str__(self):
+		return "%s (%s)" % (self.handler, self.status)
+
+	@classmethod
+	def schedule(cls, event, receiver, run_async=False):
+		"""
+		Create a pending job running the receiver for the event.
+
+		If run_async is True, the job is submitted to the handler thread pool
+		once the current transaction commits. Otherwise (or if the process
+		exits before the job ran), it is run by `process_pending()`.
+		"""
+		job = cls.objects.create(webhook_event=event, handler=get_receiver_name(receiver))
+		if run_async:
+			transaction.on_commit(partial(get_executor().submit, cls.run_in_thread, job.pk))
+		return job
+
+	@staticmethod
+	def get_stale_running_q():
+		"""
+		Running jobs claimed more than settings.PAYPAL_WEBHOOK_CLAIM_TIMEOUT
+		seconds ago, whose worker presumably died.
+		"""
+		stale = now() - timedelta(seconds=PAYPAL_WEBHOOK_CLAIM_TIMEOUT)
+		return Q(status=enums.WebhookHandlerJobStatus.running) & (
+			Q(started__lt=stale) | Q(started__isnull=True)
+		)
+
+	@classmethod
+	def get_claimable_q(cls):
+		return Q(status=enums.WebhookHandlerJobStatus.pending) | cls.get_stale_running_q()
+
+	@classmethod
+	def claim(cls, queryset):
+		return queryset.filter(cls.get_claimable_q()).update(
+			status=enums.WebhookHandlerJobStatus.running, started=now()
+		)
+
+	@classmethod
+	def run_in_thread(cls, pk):
+		"""
+		Run a pending job from a thread pool, if no worker claimed it already.
+		"""
+		close_old_connections()
+		try:
+			if cls.claim(cls.objects.filter(pk=pk)):
+				cls.objects.select_related("webhook_event").get(pk=pk).run()
+		finally:
+			close_old_connections()
+
+	@classmethod
+	def process_pending(cls, batch_size=100):
+		"""
+		Claim a batch of pending jobs, then run them.
+
+		Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so that
+		several workers can run concurrently without running the same job
+		twice. The handlers run outside of the claiming transaction.
+		Stale running jobs (see `get_stale_running_q()`) are claimed again.
+
+		Returns the list of jobs that were run (empty if none were pending).
+		"""
+		with transaction.atomic():
+			jobs = list(
+				cls.objects.select_for_update(skip_locked=True)
+				.filter(cls.get_claimable_q())
+				.select_related("webhook_event").order_by("id")[:batch_size]
+			)
+			cls.claim(cls.objects.filter(pk__in=[job.pk for job in jobs]))
+
+		for job in jobs:
+			job.run()
+
+		return jobs
+
+	def run(self):
+		"""
+		Call the handler, recording its duration and any exception instead of
+		raising it. The job is always saved.
+		"""
+		receiver = webhook_dispatcher.get_receiver(self.handler)
+		self.started = self.started or now()
+		start = time.monotonic()
+		try:
+			if receiver is None:
+				raise LookupError("Unknown webhook handler: %r" % (self.handler))
+			receiver(
+				signal=self.webhook_event.signal, sender=WebhookEvent, event=self.webhook_event
+			)
+		except Exception as e:
+			max_length = WebhookHandlerJob._meta.get_field("exception").max_length
+			self.status = enums.WebhookHandlerJobStatus.failed
+			self.exception = str(e)[:max_length]
+			self.traceback = format_exc()
+		else:
+			self.status = enums.WebhookHandlerJobStatus.succeeded
+			self.exception = ""
+			self.traceback = ""
+		finally:
+			self.duration_ms = int((time.monotonic() - start) * 1000)
+			self.save()
+
+		return self.status == enums.WebhookHandlerJobStatus.succeeded
+
+
+def parse_body(body):
+	try:
+		return json.loads(body)
+	except ValueError:
+		return {}
+
+
+def webhook_handler(*event_types, async_=False, deferred=False):
 	"""
 	Decorator that registers a function as a webhook handler.
 
@@ -266,42 +749,94 @@ def webhook_handler(*event_types):
 
 	>>> # Hook a single event
 	>>> @webhook_handler("payment.sale.completed")
-	>>> def on_payment_received(event):
+	>>> def on_payment_received(sender, event, **kwargs):
 	>>>     payment = event.get_resource()
 	>>>     print("Received payment:", payment)
 
 	>>> # Multiple events supported
 	>>> @webhook_handler("billing.subscription.suspended", "billing.subscription.cancelled")
-	>>> def on_subscription_stop(event):
+	>>> def on_subscription_stop(sender, event, **kwargs):
 	>>>     subscription = event.get_resource()
 	>>>     print("Stopping subscription:", subscription)
 
 	>>> # Using a wildcard works as well
 	>>> @webhook_handler("billing.subscription.*")
-	>>> def on_subscription_update(event):
+	>>> def on_subscription_update(sender, event, **kwargs):
 	>>>     subscription = event.get_resource()
 	>>>     print("Updated subscription:", subscription)
+
+	Wildcards are matched when the event is received, so they also match
+	event types which dj-paypal does not know about. A ValueError is raised
+	for malformed patterns.
+
+	By default, handlers are called inline while the webhook is processed,
+	and their exceptions make the processing fail. Slow handlers can be run
+	out of band instead, with their duration and exceptions recorded in a
+	WebhookHandlerJob:
+
+	>>> # Run on a thread pool once the webhook is processed
+	>>> @webhook_handler("payment.sale.completed", async_=True)
+	>>> def send_receipt(sender, event, **kwargs):
+	>>>     ...
+
+	>>> # Run by the djpaypal_run_webhook_handlers management command
+	>>> @webhook_handler("billing.subscription.created", deferred=True)
+	>>> def grant_entitlements(sender, event, **kwargs):
+	>>>     ...
+
+	Async and deferred handlers must be module-level functions, so that
+	they can be found again by name.
+
+	Handlers are called with the signal of the event type in WEBHOOK_SIGNALS
+	(None for unknown event types), the sender and the event as keyword
+	arguments. They are not connected to that signal, though: disconnect
+	them with `webhook_dispatcher.disconnect(pattern, func)`.
 	"""
 
-	# First expand all wildcards and verify the event types are valid
-	event_types_to_register = set()
-	for event_type in event_types:
-		# Always convert to lowercase
-		event_type = event_type.lower()
-		if "*" in event_type:
-			# expand it
-			for t in WEBHOOK_EVENT_TYPES:
-				if fnmatch(t, event_type):
-					event_types_to_register.add(t)
-		elif event_type not in WEBHOOK_EVENT_TYPES:
-			raise ValueError("Unknown webhook event: %r" % (event_type))
-		else:
-			event_types_to_register.add(event_type)
+	if async_ and deferred:
+		raise ValueError("A webhook handler cannot be both async and deferred")
+	mode = ASYNC if async_ else DEFERRED if deferred else SYNC
+
+	# Verify the patterns before registering anything
+	patterns = [webhook_dispatcher.normalize_pattern(event_type) for event_type in event_types]
 
-	# Now register them
 	def decorator(func):
-		for event_type in event_types_to_register:
-			WEBHOOK_SIGNALS[event_type].connect(func)
+		for pattern in patterns:
+			webhook_dispatcher.connect(pattern, func, mode=mode)
 		return func
 
 	return decorator
+
+
+def register_webhook_resource(resource_type, model):
+	"""
+	Register the model that the resource of webhook events with the given
+	resource_type is synced to.
+
+	The model must be a PaypalObject subclass. Registering an existing
+	resource type replaces its model.
+	"""
+	if not issubclass(model, PaypalObject):
+		raise TypeError("%r is not a PaypalObject subclass" % (model))
+	WEBHOOK_RESOURCE_MODELS[resource_type.lower()] = model
+
+
+def register_webhook_event(event_type, sync_resource=True):
+	"""
+	Register a webhook event type which is not known to dj-paypal, adding
+	a signal for it to WEBHOOK_SIGNALS.
+
+	If sync_resource is False, the resource of the event is not synced
+	to the database when the event is processed. The event type may end
+	with ".*" to match all the event types with that prefix.
+	"""
+	event_type = event_type.lower()
+	if event_type not in WEBHOOK_SIGNALS and not event_type.endswith(".*"):
+		WEBHOOK_EVENT_TYPES.add(event_type)
+		WEBHOOK_SIGNALS[event_type] = signal = Signal()
+		_WEBHOOK_SIGNAL_LOOKUP[event_type] = signal
+		_WEBHOOK_SIGNAL_LOOKUP[event_type.upper()] = signal
+	if sync_resource:
+		WEBHOOK_UNSYNCED_EVENT_TYPES.discard(event_type)
+	else:
+		WEBHOOK_UNSYNCED_EVENT_TYPES.add(event_type)
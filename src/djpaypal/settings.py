@@ -9,12 +9,70 @@ PAYPAL_LIVE_MODE = PAYPAL_MODE == "live"
 
 PAYPAL_WEBHOOK_ID = getattr(settings, "PAYPAL_WEBHOOK_ID", "")
 
+# If True, webhooks are only stored when received, and are verified and
+# processed later by the djpaypal_process_webhooks management command.
+PAYPAL_WEBHOOK_DEFERRED = getattr(settings, "PAYPAL_WEBHOOK_DEFERRED", False)
+# Number of seconds after which a pending webhook (or a running webhook handler)
+# claimed by a worker which did not complete it can be claimed again.
+PAYPAL_WEBHOOK_CLAIM_TIMEOUT = getattr(settings, "PAYPAL_WEBHOOK_CLAIM_TIMEOUT", 600)
+# Number of threads running the webhook handlers registered with async_=True
+PAYPAL_WEBHOOK_HANDLER_THREADS = getattr(settings, "PAYPAL_WEBHOOK_HANDLER_THREADS", 4)
+
+# If set to "zlib" or "zstd" (requires zstandard), the body of the incoming
+# webhooks is stored compressed.
+PAYPAL_WEBHOOK_BODY_COMPRESSION = getattr(settings, "PAYPAL_WEBHOOK_BODY_COMPRESSION", None)
+
+# Number of days after which the processed, failed and invalid webhooks are
+# deleted by the djpaypal_prune_webhooks management command (None keeps them).
+PAYPAL_WEBHOOK_RETENTION = getattr(settings, "PAYPAL_WEBHOOK_RETENTION", {})
+
+# Paths to the PEM certificates trusted to sign the webhook certificates.
+# Defaults to the certificate chain shipped with paypalrestsdk.
+PAYPAL_WEBHOOK_CA_CERTS = getattr(settings, "PAYPAL_WEBHOOK_CA_CERTS", None)
+# The cache used to store the webhook certificates (None to disable)
+PAYPAL_WEBHOOK_CERT_CACHE = getattr(settings, "PAYPAL_WEBHOOK_CERT_CACHE", "default")
+
+# Maximum number of concurrent API requests made when fetching objects to sync
+PAYPAL_SYNC_CONCURRENCY = getattr(settings, "PAYPAL_SYNC_CONCURRENCY", 1)
+
+# Maximum age (in seconds) of a related object (eg. the billing agreement of a
+# sale) before it gets refetched from the API. None always refetches it.
+PAYPAL_RESYNC_MAX_AGE = getattr(settings, "PAYPAL_RESYNC_MAX_AGE", None)
+# If True, stale related objects are not refetched inline. The
+# djpaypal.models.base.resync_requested signal is sent instead.
+PAYPAL_RESYNC_DEFERRED = getattr(settings, "PAYPAL_RESYNC_DEFERRED", False)
+
+# If True, the database queries and API calls made while processing webhooks
+# and syncing objects are recorded (see djpaypal.instrumentation).
+PAYPAL_INSTRUMENTATION = getattr(settings, "PAYPAL_INSTRUMENTATION", False)
+
+# If True, Prometheus metrics are recorded (requires prometheus_client)
+PAYPAL_METRICS = getattr(settings, "PAYPAL_METRICS", False)
+
+# The cache used by BillingAgreement.objects.has_active() (None to disable), and
+# how long (in seconds) the entitlements of a user are cached.
+PAYPAL_ENTITLEMENT_CACHE = getattr(settings, "PAYPAL_ENTITLEMENT_CACHE", None)
+PAYPAL_ENTITLEMENT_CACHE_TIMEOUT = getattr(
+	settings, "PAYPAL_ENTITLEMENT_CACHE_TIMEOUT", 300
+)
+
+# HTTP connection pool size, timeout (seconds) and retries of the API client
+PAYPAL_HTTP_POOL_SIZE = getattr(settings, "PAYPAL_HTTP_POOL_SIZE", 10)
+PAYPAL_HTTP_TIMEOUT = getattr(settings, "PAYPAL_HTTP_TIMEOUT", 30)
+PAYPAL_HTTP_MAX_RETRIES = getattr(settings, "PAYPAL_HTTP_MAX_RETRIES", 3)
+# The cache in which the API access token is shared between processes (None to disable)
+PAYPAL_TOKEN_CACHE = getattr(settings, "PAYPAL_TOKEN_CACHE", "default")
+
 PAYPAL_SETTINGS = {
 	"mode": PAYPAL_MODE,
 	"client_id": PAYPAL_CLIENT_ID,
 	"client_secret": PAYPAL_CLIENT_SECRET,
+	"pool_size": PAYPAL_HTTP_POOL_SIZE,
+	"timeout": PAYPAL_HTTP_TIMEOUT,
+	"max_retries": PAYPAL_HTTP_MAX_RETRIES,
+	"token_cache": PAYPAL_TOKEN_CACHE,
 }
 
 if PAYPAL_CLIENT_ID and PAYPAL_CLIENT_SECRET:
-	from paypalrestsdk import configure
+	from .api import configure
 	configure(PAYPAL_SETTINGS)
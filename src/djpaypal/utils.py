@@ -1,9 +1,19 @@
+import zlib
 from decimal import Decimal
 
 from django.urls import NoReverseMatch, reverse
 from django.utils.html import format_html
 
 
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
 def admin_urlify(column, help_text=None):  # pragma: no cover
 	"""
 	Can be used to add a link to a model referenced in another admin.
@@ -78,3 +88,26 @@ def get_version():
 	"""
 	from . import __version__
 	return __version__
+
+
+def compress(data, method="zlib"):
+	"""
+	Compress bytes with zlib or zstd (requires the zstandard package).
+	"""
+	if method == "zstd":
+		return zstandard.ZstdCompressor().compress(data)
+	elif method == "zlib":
+		return zlib.compress(data)
+	raise ValueError("Unknown compression method: %r" % (method))
+
+
+def decompress(data):
+	"""
+	Decompress bytes compressed by compress(), detecting the method used.
+	"""
+	data = bytes(data)
+	if data.startswith(ZSTD_MAGIC):
+		if zstandard is None:
+			raise RuntimeError("The zstandard package is required to decompress this data")
+		return zstandard.ZstdDecompressor().decompress(data)
+	return zlib.decompress(data)
@@ -0,0 +1,254 @@
+"""
+Local verification of Paypal webhook signatures.
+
+This replaces paypalrestsdk.notifications.WebhookEvent.verify(), which
+downloads the signing certificate for every single webhook.
+Certificates are cached in-process and in the Django cache until they expire.
+"""
+import binascii
+import hashlib
+import os
+import threading
+from base64 import b64decode
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import paypalrestsdk
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.x509.oid import NameOID
+from django.core.cache import caches
+
+from .api import get_session
+from .settings import PAYPAL_WEBHOOK_CA_CERTS, PAYPAL_WEBHOOK_CERT_CACHE
+
+
+AUTH_ALGORITHMS = {
+	"SHA256withRSA": hashes.SHA256,
+	"SHA1withRSA": hashes.SHA1,
+}
+
+CERT_DOWNLOAD_TIMEOUT = 10
+
+# Maximum number of CA certificates between a webhook certificate and its root
+MAX_CHAIN_LENGTH = 8
+
+SDK_CA_CERTS = [
+	os.path.join(os.path.dirname(paypalrestsdk.__file__), "data", filename) for filename in (
+		"DigiCertHighAssuranceEVRootCA.crt.pem",
+		"DigiCertSHA2ExtendedValidationServerCA.crt.pem",
+	)
+]
+
+
+class CertificateCache:
+	"""
+	A thread-safe LRU cache of verified certificates, keyed by URL.
+	Entries are evicted once the certificate has expired.
+	"""
+	def __init__(self, maxsize=16):
+		self.maxsize = maxsize
+		self._certs = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, url):
+		with self._lock:
+			if url not in self._certs:
+				return None
+			cert, expires = self._certs[url]
+			if expires <= datetime.now(timezone.utc):
+				del self._certs[url]
+				return None
+			self._certs.move_to_end(url)
+			return cert
+
+	def set(self, url, cert, expires):
+		with self._lock:
+			self._certs[url] = (cert, expires)
+			self._certs.move_to_end(url)
+			while len(self._certs) > self.maxsize:
+				self._certs.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._certs.clear()
+
+
+certificate_cache = CertificateCache()
+
+
+def is_valid_cert_url(cert_url):
+	"""
+	Check that the certificate is served by Paypal over HTTPS.
+	"""
+	url = urlparse(cert_url)
+	host = (url.hostname or "").lower()
+	return url.scheme == "https" and (host == "paypal.com" or host.endswith(".paypal.com"))
+
+
+@lru_cache(maxsize=None)
+def get_trusted_certificates():
+	"""
+	Return the CA certificates trusted to issue the webhook certificates.
+	"""
+	certs = []
+	for path in PAYPAL_WEBHOOK_CA_CERTS or SDK_CA_CERTS:
+		with open(path, "rb") as f:
+			certs.extend(x509.load_pem_x509_certificates(f.read()))
+	return certs
+
+
+def get_certificate_expiry(cert):
+	if hasattr(cert, "not_valid_after_utc"):
+		return cert.not_valid_after_utc
+	# cryptography < 42
+	return cert.not_valid_after.replace(tzinfo=timezone.utc)
+
+
+def get_certificate_start(cert):
+	if hasattr(cert, "not_valid_before_utc"):
+		return cert.not_valid_before_utc
+	# cryptography < 42
+	return cert.not_valid_before.replace(tzinfo=timezone.utc)
+
+
+def is_certificate_current(cert):
+	current_time = datetime.now(timezone.utc)
+	return get_certificate_start(cert) <= current_time < get_certificate_expiry(cert)
+
+
+def is_ca_certificate(cert):
+	try:
+		return cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+	except x509.ExtensionNotFound:
+		return False
+
+
+def get_issuer(cert):
+	"""
+	Return the trusted certificate which issued `cert` (checking its
+	signature), or None.
+	"""
+	for issuer in get_trusted_certificates():
+		if issuer.subject != cert.issuer:
+			continue
+		try:
+			cert.verify_directly_issued_by(issuer)
+		except (InvalidSignature, TypeError, ValueError):
+			continue
+		return issuer
+	return None
+
+
+def is_trusted_certificate(cert):
+	"""
+	Check that the certificate chains up to a self-signed trusted certificate,
+	through current CA certificates.
+	"""
+	for _ in range(MAX_CHAIN_LENGTH):
+		issuer = get_issuer(cert)
+		if issuer is None or not is_ca_certificate(issuer):
+			return False
+		if not is_certificate_current(issuer):
+			return False
+		if issuer.subject == issuer.issuer:
+			return True
+		cert = issuer
+	return False
+
+
+def verify_certificate(cert):
+	"""
+	Check that the certificate is unexpired, issued to Paypal and trusted.
+	"""
+	if not is_certificate_current(cert):
+		return False
+
+	common_names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+	if not common_names or not common_names[0].value.lower().endswith(".paypal.com"):
+		return False
+
+	return is_trusted_certificate(cert)
+
+
+def download_certificate(cert_url):
+	response = get_session().get(cert_url, timeout=CERT_DOWNLOAD_TIMEOUT)
+	response.raise_for_status()
+	return response.text
+
+
+def get_certificate(cert_url):
+	"""
+	Return the verified certificate found at `cert_url`, or None if it is
+	not a valid Paypal certificate.
+
+	Certificates are looked up in the in-process cache, then in the Django
+	cache (settings.PAYPAL_WEBHOOK_CERT_CACHE) and are only downloaded
+	if missing from both.
+	"""
+	if not is_valid_cert_url(cert_url):
+		return None
+
+	cert = certificate_cache.get(cert_url)
+	if cert is not None:
+		return cert
+
+	cache = caches[PAYPAL_WEBHOOK_CERT_CACHE] if PAYPAL_WEBHOOK_CERT_CACHE else None
+	cache_key = "djpaypal:webhook-cert:" + hashlib.sha256(cert_url.encode("utf-8")).hexdigest()
+	pem = cache.get(cache_key) if cache else None
+	from_cache = pem is not None
+	if not from_cache:
+		pem = download_certificate(cert_url)
+
+	try:
+		cert = x509.load_pem_x509_certificate(pem.encode("utf-8"))
+	except ValueError:
+		return None
+
+	if not verify_certificate(cert):
+		return None
+
+	expires = get_certificate_expiry(cert)
+	certificate_cache.set(cert_url, cert, expires)
+	if cache and not from_cache:
+		timeout = (expires - datetime.now(timezone.utc)).total_seconds()
+		cache.set(cache_key, pem, timeout=int(timeout))
+
+	return cert
+
+
+def get_expected_signature_data(transmission_id, timestamp, webhook_id, event_body):
+	crc = binascii.crc32(event_body.encode("utf-8"))
+	return "{}|{}|{}|{}".format(transmission_id, timestamp, webhook_id, crc).encode("utf-8")
+
+
+def verify_webhook(
+	transmission_id, timestamp, webhook_id, event_body, cert_url, actual_sig, auth_algo
+):
+	"""
+	Verify that a webhook was sent by Paypal, unaltered and targeted at the
+	webhook `webhook_id`.
+
+	Same interface as paypalrestsdk.notifications.WebhookEvent.verify().
+	"""
+	algorithm = AUTH_ALGORITHMS.get(auth_algo)
+	if algorithm is None:
+		return False
+
+	cert = get_certificate(cert_url)
+	if cert is None:
+		return False
+
+	data = get_expected_signature_data(transmission_id, timestamp, webhook_id, event_body)
+	try:
+		cert.public_key().verify(
+			b64decode(actual_sig), data, padding.PKCS1v15(), algorithm()
+		)
+	except (InvalidSignature, ValueError):
+		return False
+
+	return True
@@ -1,8 +1,11 @@
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseServerError
+from django.http import (
+	Http404, HttpResponse, HttpResponseBadRequest, HttpResponseServerError
+)
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from . import metrics
 from .models import WebhookEventTrigger
 
 
@@ -14,6 +17,10 @@ class ProcessWebhookView(View):
 	This will create a WebhookEventTrigger instance, verify it,
 	then attempt to process it.
 
+	In deferred mode (settings.PAYPAL_WEBHOOK_DEFERRED), the instance is only
+	stored and the view returns immediately. It is then verified and processed
+	by the djpaypal_process_webhooks management command.
+
 	If the webhook cannot be verified, returns HTTP 400.
 
 	If an exception happens during processing, returns HTTP 500.
@@ -25,13 +32,56 @@ class ProcessWebhookView(View):
 			return HttpResponseBadRequest()
 
 		trigger = WebhookEventTrigger.from_request(request)
+		return get_trigger_response(trigger)
 
-		if trigger.exception:
-			# An exception happened, return 500
-			return HttpResponseServerError()
 
-		if not trigger.valid:
-			# Webhook Event did not validate, return 400
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncProcessWebhookView(View):
+	"""
+	An async version of ProcessWebhookView, for ASGI deployments.
+
+	Combined with deferred mode, webhooks are stored without blocking the
+	event loop, so that a single worker can absorb bursts of deliveries.
+	Otherwise, the webhook is verified and processed in a worker thread.
+	"""
+	async def post(self, request):
+		if "HTTP_PAYPAL_TRANSMISSION_ID" not in request.META:
 			return HttpResponseBadRequest()
 
+		trigger = await WebhookEventTrigger.afrom_request(request)
+		return get_trigger_response(trigger)
+
+
+class MetricsView(View):
+	"""
+	Exposes the Prometheus metrics (settings.PAYPAL_METRICS).
+
+	Returns HTTP 404 if metrics are disabled. Protect this view as needed.
+	"""
+	def get(self, request):
+		if not metrics.ENABLED:
+			raise Http404("Metrics are disabled")
+
+		return HttpResponse(
+			metrics.prometheus_client.generate_latest(),
+			content_type=metrics.prometheus_client.CONTENT_TYPE_LATEST,
+		)
+
+
+def get_trigger_response(trigger):
+	metrics.webhook_received(trigger)
+
+	if trigger.pending or trigger.processing:
+		# Deferred mode, or duplicate delivery of a trigger being processed:
+		# the trigger will be (or is being) processed
 		return HttpResponse(str(trigger.id))
+
+	if trigger.exception:
+		# An exception happened, return 500
+		return HttpResponseServerError()
+
+	if not trigger.valid:
+		# Webhook Event did not validate, return 400
+		return HttpResponseBadRequest()
+
+	return HttpResponse(str(trigger.id))
@@ -1,4 +1,7 @@
+from datetime import timedelta
+
 import pytest
+from django.utils.timezone import now
 
 from djpaypal import models
 
@@ -12,3 +15,17 @@ def test_billingagreement_admin_view(admin_client):
 
 	response = admin_client.get("/admin/djpaypal/billingagreement/{}/change/".format(inst.id))
 	assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_billingagreement_admin_expire(admin_client):
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, created = models.BillingAgreement.get_or_update_from_api_data(ba, always_sync=True)
+	models.BillingAgreement.objects.update(end_of_period=now() + timedelta(days=30))
+
+	response = admin_client.post("/admin/djpaypal/billingagreement/", {
+		"action": "expire", "_selected_action": [inst.id],
+	})
+	assert response.status_code == 302
+	inst.refresh_from_db()
+	assert now() - timedelta(minutes=1) < inst.end_of_period <= now()
@@ -0,0 +1,84 @@
+import json
+from unittest import mock
+
+import requests
+from django.core.cache import cache
+
+from djpaypal.api import PaypalApi
+
+
+def make_response(status_code, content=b"{}"):
+	response = requests.Response()
+	response.status_code = status_code
+	response._content = content
+	return response
+
+
+def test_paypal_api_uses_pooled_session():
+	api = PaypalApi(
+		mode="sandbox", client_id="client_id", client_secret="client_secret", token="token",
+		pool_size=4, timeout=5, max_retries=2,
+	)
+	adapter = api.session.get_adapter(api.endpoint)
+	assert adapter._pool_maxsize == 4
+	assert adapter.max_retries.total == 2
+	assert 503 in adapter.max_retries.status_forcelist
+
+	with mock.patch.object(
+		api.session, "request", return_value=make_response(200, b'{"id": "P-123"}')
+	) as request:
+		assert api.get("v1/payments/billing-plans/P-123") == {"id": "P-123"}
+		assert api.get("v1/payments/billing-plans/P-123") == {"id": "P-123"}
+
+	assert request.call_count == 2
+	method, url = request.call_args.args
+	assert method == "GET"
+	assert url == "https://api.sandbox.paypal.com/v1/payments/billing-plans/P-123"
+	assert request.call_args.kwargs["timeout"] == 5
+	assert request.call_args.kwargs["headers"]["Authorization"] == "Bearer token"
+
+
+def mock_paypal(api, tokens, statuses=()):
+	"""
+	Mock the HTTP session of `api`, returning the access tokens in `tokens`
+	and the statuses in `statuses` for the other requests (then 200).
+	"""
+	tokens, statuses = list(tokens), list(statuses)
+
+	def request(method, url, **kwargs):
+		if url.endswith("/v1/oauth2/token"):
+			token = {"access_token": tokens.pop(0), "token_type": "Bearer", "expires_in": 32400}
+			return make_response(200, json.dumps(token).encode("utf-8"))
+		return make_response(statuses.pop(0) if statuses else 200)
+
+	return mock.patch.object(api.session, "request", side_effect=request)
+
+
+def get_token_requests(request):
+	return [call for call in request.call_args_list if call.args[1].endswith("/oauth2/token")]
+
+
+def test_paypal_api_shares_access_token():
+	cache.clear()
+	options = {
+		"mode": "sandbox", "client_id": "client_id", "client_secret": "client_secret",
+		"token_cache": "default",
+	}
+	api1, api2 = PaypalApi(options), PaypalApi(options)
+
+	with mock_paypal(api1, ["token1"]) as request:
+		api1.get("v1/payments/billing-plans/P-123")
+	assert len(get_token_requests(request)) == 1
+
+	with mock_paypal(api2, []) as request:
+		api2.get("v1/payments/billing-plans/P-123")
+	assert not get_token_requests(request)
+	assert request.call_args.kwargs["headers"]["Authorization"] == "Bearer token1"
+
+	# The token gets rejected: a new one is requested and shared
+	with mock_paypal(api2, ["token2"], statuses=[401]) as request:
+		api2.get("v1/payments/billing-plans/P-123")
+	assert len(get_token_requests(request)) == 1
+	assert request.call_args.kwargs["headers"]["Authorization"] == "Bearer token2"
+	assert cache.get(api1.token_cache_key)["token_hash"]["access_token"] == "token2"
+	cache.clear()
@@ -1,9 +1,21 @@
+import copy
+import threading
+import time
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
 import pytest
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from iso8601 import parse_date
 from paypalrestsdk import payments as paypal_models
 
 from djpaypal import enums, models, settings
 
+from . import conftest
 from .conftest import get_fixture
 
 
@@ -40,6 +52,175 @@ def test_sync_all_active_plans():
 			assert plan.payment_definitions.filter(id=pd.id).count() == 1
 
 
+@pytest.mark.django_db
+def test_resync_unchanged_plan():
+	plan_obj = get_fixture("GET/v1/payments/billing-plans/P-02767725HB885221P6IAFNQA.json")
+	plan, created = models.BillingPlan.get_or_update_from_api_data(plan_obj)
+	assert created
+	assert plan.djpaypal_data_hash
+
+	with CaptureQueriesContext(connection) as ctx:
+		models.BillingPlan.get_or_update_from_api_data(plan_obj)
+	assert not [q for q in ctx.captured_queries if not q["sql"].startswith("SELECT")]
+	assert not [
+		q for q in ctx.captured_queries
+		if "djpaypal_billingplan_payment_definitions" in q["sql"]
+	]
+
+	plan_obj["name"] = "Renamed plan"
+	plan, created = models.BillingPlan.get_or_update_from_api_data(plan_obj)
+	plan.refresh_from_db()
+	assert plan.name == "Renamed plan"
+	assert plan.djpaypal_data_hash == models.BillingPlan.clean_and_hash_api_data(
+		plan_obj
+	)[1]["djpaypal_data_hash"]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("bulk", [False, True])
+def test_sync_plans_from_generator(bulk):
+	all_plans = get_fixture("rest.billingplan.all.active.json")
+	plans = models.BillingPlan.objects.sync_data(
+		(plan for plan in all_plans["plans"]), bulk=bulk
+	)
+	assert [plan.id for plan in plans] == [plan["id"] for plan in all_plans["plans"]]
+
+
+@pytest.mark.django_db
+def test_bulk_sync_all_active_plans():
+	all_plans = get_fixture("rest.billingplan.all.active.json")
+	plans = models.BillingPlan.objects.sync_data(all_plans["plans"], bulk=True)
+	assert [plan.id for plan in plans] == [plan["id"] for plan in all_plans["plans"]]
+	assert models.BillingPlan.objects.count() == len(all_plans["plans"])
+
+	for plan in plans:
+		plan_obj = get_fixture("GET/v1/payments/billing-plans/{id}.json".format(id=plan.id))
+		assert plan.payment_definitions.count() == len(plan_obj["payment_definitions"])
+
+	# Syncing again updates the existing objects
+	plan_obj = get_fixture("GET/v1/payments/billing-plans/{id}.json".format(id=plans[0].id))
+	plan_obj["state"] = "INACTIVE"
+	models.BillingPlan.objects.sync_data([plan_obj], fetch=False, bulk=True)
+	plan = models.BillingPlan.objects.get(id=plan_obj["id"])
+	assert plan.state == enums.BillingPlanState.INACTIVE
+	assert plan.payment_definitions.count() == len(plan_obj["payment_definitions"])
+	assert models.BillingPlan.objects.count() == len(all_plans["plans"])
+
+
+@pytest.mark.django_db
+def test_bulk_sync_duplicate_plans():
+	plan_obj = get_fixture("GET/v1/payments/billing-plans/P-02767725HB885221P6IAFNQA.json")
+	changed = copy.deepcopy(plan_obj)
+	changed["state"] = "INACTIVE"
+	changed["payment_definitions"].append(
+		dict(changed["payment_definitions"][0], id="PD-EXTRA")
+	)
+
+	# New object: the payment definitions of the last version are linked
+	plan, _ = models.BillingPlan.objects.sync_data(
+		[changed, plan_obj], fetch=False, bulk=True
+	)
+	assert plan.state == enums.BillingPlanState.ACTIVE
+	assert "PD-EXTRA" not in set(plan.payment_definitions.values_list("id", flat=True))
+
+	# Existing object, the last version is the stored one
+	models.BillingPlan.objects.sync_data([changed, plan_obj], fetch=False, bulk=True)
+	plan.refresh_from_db()
+	assert plan.state == enums.BillingPlanState.ACTIVE
+	assert "PD-EXTRA" not in set(plan.payment_definitions.values_list("id", flat=True))
+
+	models.BillingPlan.objects.sync_data([plan_obj, changed], fetch=False, bulk=True)
+	plan.refresh_from_db()
+	assert plan.state == enums.BillingPlanState.INACTIVE
+	assert "PD-EXTRA" in set(plan.payment_definitions.values_list("id", flat=True))
+
+
+@pytest.mark.django_db
+def test_bulk_sync_concurrently_created_billing_agreement(user):
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, created = models.BillingAgreement.get_or_update_from_api_data(ba)
+	inst.user = user
+	inst.save()
+
+	# The agreement is created concurrently, after the existing ones are prefetched
+	ba["description"] = "Updated description"
+	with mock.patch.object(models.BillingAgreement.objects, "in_bulk", return_value={}):
+		models.BillingAgreement.objects.sync_data([ba], fetch=False, bulk=True)
+	inst.refresh_from_db()
+	if connection.features.supports_update_conflicts_with_target:
+		assert inst.description == "Updated description"
+	assert inst.user_id == user.id
+
+
+@pytest.mark.django_db
+def test_bulk_sync_billing_agreements():
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, = models.BillingAgreement.objects.sync_data([ba], fetch=False, bulk=True)
+	inst.refresh_from_db()
+	assert inst.end_of_period == parse_date("2017-09-24T11:47:17Z")
+	assert inst.payer_model_id == ba["payer"]["payer_info"]["payer_id"]
+
+	ba["state"] = "Canceled"
+	inst, = models.BillingAgreement.objects.sync_data([ba], fetch=False, bulk=True)
+	inst.refresh_from_db()
+	assert inst.state == enums.BillingAgreementState.Cancelled
+
+	# The payers are upserted in bulk, only when they changed
+	other = copy.deepcopy(ba)
+	other["id"] = "I-OTHER"
+	other["payer"]["payer_info"].update(payer_id="OTHERPAYER", email="other@example.com")
+	ba["state"] = "Active"
+	with CaptureQueriesContext(connection) as ctx:
+		models.BillingAgreement.objects.sync_data([ba, other], fetch=False, bulk=True)
+	payer_queries = [q for q in ctx.captured_queries if "djpaypal_payer" in q["sql"]]
+	assert len(payer_queries) == 2
+	assert models.Payer.objects.get(id="OTHERPAYER").email == "other@example.com"
+
+	ba["payer"]["payer_info"]["email"] = "changed@example.com"
+	other["state"] = "Suspended"
+	models.BillingAgreement.objects.sync_data([ba, other], fetch=False, bulk=True)
+	assert models.Payer.objects.get(id="ASDVAJS5TXSFQ").email == "changed@example.com"
+
+
+@pytest.mark.django_db
+def test_save_billing_agreement_skips_unchanged_payer():
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, created = models.BillingAgreement.get_or_update_from_api_data(ba, always_sync=True)
+	assert inst.payer_model_id == ba["payer"]["payer_info"]["payer_id"]
+
+	for obj in inst, models.BillingAgreement.objects.get(id=inst.id):
+		with CaptureQueriesContext(connection) as ctx:
+			obj.save()
+		assert not [q for q in ctx.captured_queries if "djpaypal_payer" in q["sql"]]
+
+	inst.payer["payer_info"] = dict(inst.payer["payer_info"], email="changed@example.com")
+	inst.save()
+	assert models.Payer.objects.get(id=inst.payer_model_id).email == "changed@example.com"
+
+
+@pytest.mark.django_db
+def test_sync_plans_concurrently():
+	all_plans = get_fixture("rest.billingplan.all.active.json")
+	assert len(all_plans["plans"]) == 2
+	first_plan_id = all_plans["plans"][0]["id"]
+	# Both requests must be in flight at the same time to get past the barrier
+	barrier = threading.Barrier(2, timeout=5)
+	get = conftest.TestApi.get
+
+	def slow_get(self, action, *args, **kwargs):
+		barrier.wait()
+		if first_plan_id in action:
+			# Delay the first response so that it completes last
+			time.sleep(0.1)
+		return get(self, action, *args, **kwargs)
+
+	with mock.patch.object(conftest.TestApi, "get", slow_get):
+		plans = models.BillingPlan.objects.sync_data(all_plans["plans"], concurrency=4)
+
+	assert [plan.id for plan in plans] == [plan["id"] for plan in all_plans["plans"]]
+	assert models.BillingPlan.objects.count() == len(all_plans["plans"])
+
+
 @pytest.mark.django_db
 def test_sync_executed_billing_agreement():
 	ba = get_fixture("rest.billingagreement.execute.json")
@@ -50,6 +231,85 @@ def test_sync_executed_billing_agreement():
 	assert inst.calculate_end_of_period() == parse_date("2017-09-24T11:47:17Z")
 
 
+@pytest.mark.django_db
+def test_billing_agreement_denormalized_fields():
+	ba = get_fixture("rest.billingagreement.execute.json")
+	models.BillingAgreement.get_or_update_from_api_data(ba, always_sync=True)
+
+	def check():
+		inst = models.BillingAgreement.objects.get(
+			payer_email="admin-buyer@hearthsim.net",
+			last_payment_date__lt=parse_date("2017-09-01T00:00:00Z"),
+		)
+		assert inst.next_billing_date == parse_date("2017-08-24T10:00:00Z")
+		assert inst.outstanding_balance == Decimal("0.00")
+		assert inst.cycles_completed == 0
+		assert inst.regular_frequency == enums.PaymentDefinitionFrequency.MONTH
+		assert inst.regular_frequency_interval == 1
+
+	check()
+
+	# Rows created before the fields existed are populated by the backfill command
+	models.BillingAgreement.objects.update(
+		last_payment_date=None, next_billing_date=None, outstanding_balance=None,
+		cycles_completed=None, payer_email="", regular_frequency="",
+		regular_frequency_interval=None,
+	)
+	inst = models.BillingAgreement.objects.get()
+	assert inst.calculate_end_of_period() == parse_date("2017-09-24T11:47:17Z")
+	call_command("djpaypal_backfill_billing_agreements", stdout=StringIO())
+	check()
+
+
+@pytest.mark.django_db
+def test_recompute_periods_command():
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, created = models.BillingAgreement.get_or_update_from_api_data(ba, always_sync=True)
+	end_of_period = inst.end_of_period
+	assert end_of_period == parse_date("2017-09-24T11:47:17Z")
+
+	models.BillingAgreement.objects.update(end_of_period=parse_date("2030-01-01T00:00:00Z"))
+	stdout = StringIO()
+	call_command("djpaypal_recompute_periods", "--dry-run", stdout=stdout)
+	assert "Would change the end of period of 1 of 1" in stdout.getvalue()
+
+	# Agreements whose denormalized fields were not backfilled are recomputed too
+	models.BillingAgreement.objects.update(regular_frequency="")
+	with CaptureQueriesContext(connection) as ctx:
+		call_command("djpaypal_recompute_periods", stdout=StringIO())
+	assert not [q for q in ctx.captured_queries if "djpaypal_payer" in q["sql"]]
+	inst.refresh_from_db()
+	assert inst.end_of_period == end_of_period
+
+	stdout = StringIO()
+	call_command("djpaypal_recompute_periods", stdout=stdout)
+	assert "Changed the end of period of 0 of 1" in stdout.getvalue()
+
+
+@pytest.mark.django_db
+def test_resync_billing_agreement_only_writes_changes():
+	ba = get_fixture("rest.billingagreement.execute.json")
+	models.BillingAgreement.get_or_update_from_api_data(ba)
+
+	with CaptureQueriesContext(connection) as ctx:
+		inst, created = models.BillingAgreement.get_or_update_from_api_data(ba)
+	assert not created
+	assert not [q for q in ctx.captured_queries if q["sql"].startswith("UPDATE")]
+
+	ba["description"] = "Updated description"
+	with CaptureQueriesContext(connection) as ctx:
+		inst, created = models.BillingAgreement.get_or_update_from_api_data(ba)
+	updates = [
+		q["sql"] for q in ctx.captured_queries
+		if q["sql"].startswith('UPDATE "djpaypal_billingagreement"')
+	]
+	assert len(updates) == 1
+	assert '"description"' in updates[0]
+	assert '"agreement_details"' not in updates[0]
+	inst.refresh_from_db()
+	assert inst.description == "Updated description"
+
+
 @pytest.mark.django_db
 def test_sync_canceled_billing_agreement():
 	ba = get_fixture("rest.billingagreement.execute.json")
@@ -75,3 +335,86 @@ class TestPreparedBillingAgreement:
 		)
 		links = {"links": [{"href": url, "method": "POST", "rel": "execute"}]}
 		assert models.PreparedBillingAgreement._extract_token(links) == token
+
+
+@pytest.mark.django_db
+def test_billing_plan_price_summary(django_assert_num_queries):
+	all_plans = get_fixture("rest.billingplan.all.active.json")
+	models.BillingPlan.objects.sync_data(all_plans["plans"])
+
+	plans = models.BillingPlan.objects.order_by("id")
+	prices = {}
+	for plan in plans:
+		assert plan.price_summary
+		assert plan.price_summary == plan.regular_payment_definition.human_readable_price
+		prices[plan.id] = plan.price_summary
+
+	# One query each for the plans, payment definitions and charge models
+	with django_assert_num_queries(3):
+		for plan in models.BillingPlan.objects.with_payment_definitions().order_by("id"):
+			pd = plan.regular_payment_definition
+			list(pd.charge_models.all())
+			assert pd.human_readable_price == prices[plan.id]
+
+
+@pytest.mark.django_db
+def test_billing_agreement_active_for(user, django_capture_on_commit_callbacks):
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, created = models.BillingAgreement.get_or_update_from_api_data(ba, always_sync=True)
+	plan, created = models.BillingPlan.get_or_update_from_api_data(
+		get_fixture("GET/v1/payments/billing-plans/P-02767725HB885221P6IAFNQA.json")
+	)
+	inst.user = user
+	inst.plan_model = plan
+	inst.save()
+
+	with mock.patch("djpaypal.models.billing.now", return_value=parse_date("2017-09-01")):
+		assert list(models.BillingAgreement.objects.active_for(user)) == [inst]
+		assert list(models.BillingAgreement.objects.active_for(user, plan)) == [inst]
+		assert not models.BillingAgreement.objects.active_for(user, "P-OTHER").exists()
+
+		with mock.patch("djpaypal.models.billing.PAYPAL_ENTITLEMENT_CACHE", "default"):
+			assert models.BillingAgreement.objects.has_active(user, plan)
+			assert not models.BillingAgreement.objects.has_active(user, "P-OTHER")
+
+			# The entitlements are cached
+			with CaptureQueriesContext(connection) as ctx:
+				assert models.BillingAgreement.objects.has_active(user)
+			assert not ctx.captured_queries
+
+			# Saving the billing agreement invalidates the cache
+			with django_capture_on_commit_callbacks(execute=True):
+				inst.state = enums.BillingAgreementState.Pending
+				inst.save()
+			assert not models.BillingAgreement.objects.has_active(user)
+
+	assert not models.BillingAgreement.objects.active_for(user).exists()
+
+
+@pytest.mark.django_db
+def test_billing_agreement_entitlement_invalidation(
+	user, django_capture_on_commit_callbacks
+):
+	ba = get_fixture("rest.billingagreement.execute.json")
+	inst, created = models.BillingAgreement.get_or_update_from_api_data(ba, always_sync=True)
+	inst.user = user
+	inst.save()
+
+	# The cache is invalidated after the write, not refilled from the old row
+	def on_commit(callback):
+		states.append(models.BillingAgreement.objects.get(id=inst.id).state)
+
+	states = []
+	inst.state = enums.BillingAgreementState.Pending
+	with mock.patch("djpaypal.models.billing.transaction.on_commit", on_commit):
+		inst.save()
+	assert states == [enums.BillingAgreementState.Pending]
+
+	# Moving the agreement to another user invalidates the cache of both users
+	other = get_user_model().objects.create_user(username="other@example.com")
+	inst = models.BillingAgreement.objects.get(id=inst.id)
+	inst.user = other
+	with mock.patch("djpaypal.models.billing.invalidate_entitlement_cache") as invalidate:
+		with django_capture_on_commit_callbacks(execute=True):
+			inst.save()
+	assert set(invalidate.call_args.args) == {user.id, other.id}
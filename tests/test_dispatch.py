@@ -0,0 +1,58 @@
+import pytest
+
+from djpaypal.dispatch import WebhookDispatcher
+
+
+def make_receiver(name):
+	def receiver(sender, event, **kwargs):
+		pass
+	receiver.__name__ = name
+	return receiver
+
+
+def test_dispatcher_patterns():
+	dispatcher = WebhookDispatcher()
+	everything = make_receiver("everything")
+	subscription = make_receiver("subscription")
+	completed = make_receiver("completed")
+	reactivated = make_receiver("reactivated")
+	exact = make_receiver("exact")
+
+	dispatcher.connect("*", everything)
+	dispatcher.connect("billing.subscription.*", subscription)
+	dispatcher.connect("payment.*.completed", completed)
+	dispatcher.connect("billing.subscription.re-*", reactivated)
+	dispatcher.connect("BILLING.SUBSCRIPTION.CREATED", exact)
+
+	assert dispatcher.get_receivers("BILLING.SUBSCRIPTION.CREATED") == (
+		everything, subscription, exact
+	)
+	assert dispatcher.get_receivers("billing.subscription.re-activated") == (
+		everything, subscription, reactivated
+	)
+	assert dispatcher.get_receivers("PAYMENT.SALE.COMPLETED") == (everything, completed)
+	assert dispatcher.get_receivers("payment.sale.refunded") == (everything, )
+	assert dispatcher.get_receivers("billing.subscription") == (everything, )
+
+	# Event types which are not known in advance are routed too
+	assert dispatcher.get_receivers("billing.subscription.expired") == (
+		everything, subscription
+	)
+
+	# Connecting invalidates the memoized receivers
+	late = make_receiver("late")
+	dispatcher.connect("billing.*", late)
+	assert dispatcher.get_receivers("billing.subscription.expired") == (
+		everything, subscription, late
+	)
+
+	dispatcher.disconnect("*", everything)
+	assert dispatcher.get_receivers("payment.sale.refunded") == ()
+
+
+@pytest.mark.parametrize(
+	"pattern", ["", "billing..created", "billing.plan.", "billing plan"]
+)
+def test_dispatcher_invalid_pattern(pattern):
+	with pytest.raises(ValueError):
+		WebhookDispatcher().connect(pattern, make_receiver("invalid"))
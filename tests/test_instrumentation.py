@@ -0,0 +1,54 @@
+import json
+from unittest import mock
+
+import pytest
+
+from djpaypal import models
+from djpaypal.api import PaypalApi
+from djpaypal.instrumentation import instrument, stats_recorded
+
+from .conftest import get_fixture
+from .test_api import make_response
+
+
+@pytest.mark.django_db
+def test_instrument():
+	api = PaypalApi(
+		mode="sandbox", client_id="client_id", client_secret="client_secret", token="token"
+	)
+	receiver = mock.Mock()
+	stats_recorded.connect(receiver)
+	try:
+		with mock.patch.object(api.session, "request", return_value=make_response(200)):
+			with instrument(sender=models.BillingPlan, label="test") as stats:
+				api.get("v1/payments/billing-plans/P-123")
+				assert not models.BillingPlan.objects.exists()
+				with instrument(label="nested") as nested_stats:
+					api.get("v1/payments/billing-plans/P-456")
+	finally:
+		stats_recorded.disconnect(receiver)
+
+	assert stats.api_calls == 2
+	assert stats.db_queries == 1
+	assert stats.duration > 0
+	assert nested_stats.api_calls == 1
+	assert nested_stats.db_queries == 0
+	receiver.assert_called_with(
+		signal=stats_recorded, sender=models.BillingPlan, stats=stats
+	)
+
+
+@pytest.mark.django_db
+def test_webhook_trigger_instrumentation():
+	data = get_fixture("webhooks/billing.plan.created.json")
+	trigger = models.WebhookEventTrigger.objects.create(
+		headers={}, body=json.dumps(data), remote_ip="0.0.0.0"
+	)
+	with mock.patch("djpaypal.instrumentation.PAYPAL_INSTRUMENTATION", True):
+		trigger.process()
+
+	trigger.refresh_from_db()
+	assert trigger.processing_ms is not None
+	assert trigger.db_queries > 0
+	# The test API does not make HTTP calls
+	assert trigger.api_calls == 0
@@ -0,0 +1,76 @@
+import json
+from unittest import mock
+
+import pytest
+from django.test import RequestFactory
+
+from djpaypal import metrics, models
+from djpaypal.views import MetricsView, ProcessWebhookView
+
+from .conftest import get_fixture
+
+
+prometheus_client = pytest.importorskip("prometheus_client")
+
+
+def get_webhook_count(event_type, status):
+	return prometheus_client.REGISTRY.get_sample_value(
+		"djpaypal_webhooks_total", {"event_type": event_type, "status": status}
+	) or 0
+
+
+def test_get_endpoint():
+	assert metrics.get_endpoint(
+		"https://api.sandbox.paypal.com/v1/payments/billing-plans/P-94458432VR012762KRWBZEUA"
+	) == "/v1/payments/billing-plans/{id}"
+	assert metrics.get_endpoint(
+		"https://api.paypal.com/v1/oauth2/token?grant_type=client_credentials"
+	) == "/v1/oauth2/token"
+
+
+@pytest.mark.django_db
+def test_webhook_metrics():
+	data = get_fixture("webhooks/billing.plan.created.json")
+	request = RequestFactory().post(
+		"/webhook/", data=json.dumps(data), content_type="application/json",
+		HTTP_PAYPAL_TRANSMISSION_ID="metrics-transmission-id",
+	)
+	before = {
+		status: get_webhook_count("BILLING.PLAN.CREATED", status)
+		for status in ("received", "valid", "processed")
+	}
+
+	with mock.patch.object(metrics, "ENABLED", True):
+		with mock.patch("djpaypal.models.webhooks.verify_webhook", return_value=True):
+			assert ProcessWebhookView.as_view()(request).status_code == 200
+
+		response = MetricsView.as_view()(RequestFactory().get("/metrics/"))
+		assert response.status_code == 200
+		assert b"djpaypal_webhook_processing_seconds" in response.content
+
+	for status, count in before.items():
+		assert get_webhook_count("BILLING.PLAN.CREATED", status) == count + 1
+	assert models.WebhookEventTrigger.objects.get().processed
+
+
+@pytest.mark.django_db
+def test_metrics_disabled():
+	before = get_webhook_count("BILLING.PLAN.CREATED", "processed")
+	data = get_fixture("webhooks/billing.plan.created.json")
+	trigger = models.WebhookEventTrigger(
+		headers={}, body=json.dumps(data), remote_ip="0.0.0.0"
+	)
+	trigger.process()
+	assert get_webhook_count("BILLING.PLAN.CREATED", "processed") == before
+
+
+def test_event_type_label():
+	def make_trigger(event_type):
+		return models.WebhookEventTrigger(body=json.dumps({"event_type": event_type}))
+
+	assert metrics.get_event_type_label(make_trigger("billing.plan.created")) == (
+		"BILLING.PLAN.CREATED"
+	)
+	# Arbitrary (unverified) event types do not create new time series
+	assert metrics.get_event_type_label(make_trigger("RANDOM.EVENT.1234")) == "unknown"
+	assert metrics.get_event_type_label(make_trigger(["not", "a", "string"])) == "unknown"
@@ -1,7 +1,12 @@
+from datetime import timedelta
+from unittest import mock
+
 import pytest
+from django.utils.timezone import now
 from paypalrestsdk import payments as paypal_models
 
 from djpaypal import models
+from djpaypal.models.base import resync_requested
 
 
 @pytest.mark.django_db
@@ -12,3 +17,37 @@ def test_sale_sync():
 	db_sale, created = models.Sale.get_or_update_from_api_data(sale)
 	assert created
 	assert db_sale.id == sale_id
+
+
+@pytest.mark.django_db
+def test_sale_sync_stale_billing_agreement():
+	sale = paypal_models.Sale.find("7D51924877811803R")
+	models.Sale.get_or_update_from_api_data(sale)
+	ba_id = sale["billing_agreement_id"]
+	assert models.BillingAgreement.objects.filter(id=ba_id).exists()
+
+	find = mock.Mock(wraps=paypal_models.BillingAgreement.find)
+	with mock.patch.object(paypal_models.BillingAgreement, "find", find):
+		# Fresh enough: not refetched
+		models.BillingAgreement.find_and_sync_if_stale(ba_id, max_age=3600)
+		find.assert_not_called()
+
+		last_week = now() - timedelta(days=7)
+		models.BillingAgreement.objects.filter(id=ba_id).update(djpaypal_updated=last_week)
+
+		# Stale, deferred: a resync is requested
+		receiver = mock.Mock()
+		resync_requested.connect(receiver)
+		try:
+			models.BillingAgreement.find_and_sync_if_stale(ba_id, max_age=3600, deferred=True)
+		finally:
+			resync_requested.disconnect(receiver)
+		find.assert_not_called()
+		receiver.assert_called_once_with(
+			signal=resync_requested, sender=models.BillingAgreement, id=ba_id
+		)
+
+		# Stale: refetched inline
+		ba = models.BillingAgreement.find_and_sync_if_stale(ba_id, max_age=3600)
+		find.assert_called_once_with(ba_id)
+		assert ba.djpaypal_updated > last_week
@@ -0,0 +1,151 @@
+import json
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+from django.core.cache import cache
+
+from djpaypal import models, verification
+
+
+CERT_URL = "https://api.sandbox.paypal.com/v1/notifications/certs/CERT-360caa42-fca2a594"
+WEBHOOK_ID = "1JE4291016473214C"
+TRANSMISSION_ID = "69cd13f0-d67a-11e5-baa3-778b53f4ae55"
+TIMESTAMP = "2016-02-18T20:01:35Z"
+BODY = json.dumps({
+	"id": "WH-0G2756385H040842W-5Y612302CV158622M",
+	"event_type": "PAYMENT.SALE.COMPLETED",
+})
+
+
+def make_certificate(common_name, issuer_name, issuer_key, key, days=365):
+	now = datetime.now(timezone.utc)
+	return x509.CertificateBuilder().subject_name(
+		x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+	).issuer_name(
+		x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)])
+	).public_key(key.public_key()).serial_number(
+		x509.random_serial_number()
+	).not_valid_before(now - timedelta(days=1)).not_valid_after(
+		now + timedelta(days=days)
+	).add_extension(
+		x509.BasicConstraints(ca=common_name == issuer_name, path_length=None), critical=True
+	).sign(issuer_key, hashes.SHA256())
+
+
+@pytest.fixture
+def signing_key():
+	ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+	ca_cert = make_certificate("Test CA", "Test CA", ca_key, ca_key)
+	key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+	cert = make_certificate(
+		"messageverificationcerts.sandbox.paypal.com", "Test CA", ca_key, key
+	)
+
+	pem = cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+	verification.certificate_cache.clear()
+	cache.clear()
+	with mock.patch.object(
+		verification, "get_trusted_certificates", return_value=[ca_cert]
+	):
+		with mock.patch.object(
+			verification, "download_certificate", return_value=pem
+		) as download:
+			yield key, download
+	verification.certificate_cache.clear()
+	cache.clear()
+
+
+def sign(key, body=BODY, webhook_id=WEBHOOK_ID):
+	data = verification.get_expected_signature_data(
+		TRANSMISSION_ID, TIMESTAMP, webhook_id, body
+	)
+	return b64encode(key.sign(data, padding.PKCS1v15(), hashes.SHA256())).decode("ascii")
+
+
+def verify(signature, body=BODY, cert_url=CERT_URL, auth_algo="SHA256withRSA"):
+	return verification.verify_webhook(
+		transmission_id=TRANSMISSION_ID,
+		timestamp=TIMESTAMP,
+		webhook_id=WEBHOOK_ID,
+		event_body=body,
+		cert_url=cert_url,
+		actual_sig=signature,
+		auth_algo=auth_algo,
+	)
+
+
+def test_verify_webhook(signing_key):
+	key, download = signing_key
+	assert verify(sign(key))
+	assert not verify(sign(key), body=BODY + " ")
+	assert not verify(sign(key, webhook_id="WRONG"))
+	assert not verify("not a signature")
+	assert not verify(sign(key), auth_algo="MD5withRSA")
+
+
+def test_verify_webhook_caches_certificate(signing_key):
+	key, download = signing_key
+	assert verify(sign(key))
+	assert verify(sign(key))
+	assert download.call_count == 1
+
+	# Another process only has the shared cache
+	verification.certificate_cache.clear()
+	assert verify(sign(key))
+	assert download.call_count == 1
+
+
+def test_verify_webhook_rejects_foreign_cert_url(signing_key):
+	key, download = signing_key
+	for url in (
+		"http://api.sandbox.paypal.com/v1/notifications/certs/CERT",
+		"https://api.sandbox.paypal.com.example.com/v1/notifications/certs/CERT",
+		"https://example.com/paypal.com/CERT",
+	):
+		assert not verify(sign(key), cert_url=url)
+	download.assert_not_called()
+
+
+def test_verify_webhook_rejects_untrusted_certificate(signing_key):
+	key, download = signing_key
+	with mock.patch.object(verification, "get_trusted_certificates", return_value=[]):
+		assert not verify(sign(key))
+
+	# A certificate with the same name as the trusted CA, but another key
+	other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+	other_ca = make_certificate("Test CA", "Test CA", other_key, other_key)
+	with mock.patch.object(
+		verification, "get_trusted_certificates", return_value=[other_ca]
+	):
+		assert not verify(sign(key))
+
+
+def test_sdk_ca_certificates():
+	verification.get_trusted_certificates.cache_clear()
+	certs = verification.get_trusted_certificates()
+	assert len(certs) >= 2
+	assert all(verification.is_ca_certificate(cert) for cert in certs)
+
+
+@pytest.mark.django_db
+def test_reverify_backfilled_duplicate_trigger(signing_key):
+	key, download = signing_key
+	# Duplicate deliveries stored before the transmission_id column existed
+	# were not backfilled: the id is taken from the stored headers
+	trigger = models.WebhookEventTrigger.objects.create(
+		remote_ip="0.0.0.0", body=BODY, transmission_id=None, headers={
+			"paypal-transmission-id": TRANSMISSION_ID,
+			"paypal-transmission-time": TIMESTAMP,
+			"paypal-transmission-sig": sign(key),
+			"paypal-cert-url": CERT_URL,
+			"paypal-auth-algo": "SHA256withRSA",
+		}
+	)
+	assert trigger.verify(WEBHOOK_ID)
@@ -1,10 +1,22 @@
+import gzip
 import json
+from datetime import timedelta
+from io import StringIO
 from unittest import mock
 
 import pytest
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncRequestFactory, RequestFactory
+from django.utils import timezone
 
 from djpaypal import models
-from djpaypal.models.webhooks import webhook_handler
+from djpaypal.models import webhooks
+from djpaypal.models.webhooks import (
+	register_webhook_event, register_webhook_resource, webhook_handler
+)
+from djpaypal.views import AsyncProcessWebhookView, ProcessWebhookView
 
 from .conftest import get_fixture
 
@@ -24,6 +36,27 @@ on_subscription = make_fake_signal("billing.subscription.*")
 on_subscription_created = make_fake_signal("billing.subscription.created")
 
 
+handled_events = []
+
+
+@webhook_handler("test.handler.*", deferred=True)
+def on_test_event_deferred(sender, event, **kwargs):
+	if event.event_type == "TEST.HANDLER.FAILED":
+		raise Exception("Handler failed")
+	handled_events.append(event.id)
+
+
+@webhook_handler("test.handler.async", async_=True)
+def on_test_event_async(sender, event, **kwargs):
+	handled_events.append(event.id)
+
+
+@webhook_handler("test.handler.sync")
+def on_test_event_sync(sender, event, **kwargs):
+	handled_events.append((event.id, len(connection.atomic_blocks)))
+	raise Exception("Sync handler failed")
+
+
 def get_webhook_from_fixture(event_type):
 	always_triggers.reset_mock()
 	on_subscription.reset_mock()
@@ -53,7 +86,10 @@ def test_webhook_billing_subscription_created_then_cancelled():
 	data, resource, webhook = get_webhook_from_fixture("billing.subscription.created")
 	always_triggers.assert_called_once()
 	on_subscription.assert_called_once()
-	on_subscription_created.assert_called_once()
+	on_subscription_created.assert_called_once_with(
+		signal=webhooks.WEBHOOK_SIGNALS["billing.subscription.created"],
+		sender=models.WebhookEvent, event=webhook.webhook_event,
+	)
 	assert webhook.webhook_event.id == data["id"]
 	assert webhook.webhook_event.resource["id"] == resource["id"]
 	assert models.BillingAgreement.objects.get(id=resource["id"])
@@ -66,6 +102,144 @@ def test_webhook_billing_subscription_created_then_cancelled():
 	assert models.BillingAgreement.objects.get(id=resource["id"]).state == "Cancelled"
 
 
+@pytest.fixture
+def webhook_registry():
+	"""
+	Restore the webhook event and resource registries after the test.
+	"""
+	registries = [
+		webhooks.WEBHOOK_EVENT_TYPES, webhooks.WEBHOOK_SIGNALS,
+		webhooks.WEBHOOK_RESOURCE_MODELS, webhooks.WEBHOOK_UNSYNCED_EVENT_TYPES,
+		webhooks._WEBHOOK_SIGNAL_LOOKUP,
+	]
+	saved = [registry.copy() for registry in registries]
+	yield
+	for registry, copy in zip(registries, saved):
+		registry.clear()
+		registry.update(copy)
+
+
+@pytest.mark.django_db
+def test_register_webhook_event(webhook_registry):
+	register_webhook_event("checkout.order.approved", sync_resource=False)
+	register_webhook_resource("order", models.Sale)
+	on_order_approved = make_fake_signal("checkout.order.approved")
+
+	data = get_fixture("webhooks/billing.plan.created.json")
+	data.update(
+		id="WH-CHECKOUT-ORDER", event_type="CHECKOUT.ORDER.APPROVED", resource_type="order"
+	)
+	event = models.WebhookEvent.process(data)
+
+	on_order_approved.assert_called_once()
+	assert event.resource_model is models.Sale
+	assert not models.BillingPlan.objects.exists()
+
+
+@pytest.mark.django_db
+def test_webhook_handler_unknown_event_type():
+	always_triggers.reset_mock()
+	on_plan = make_fake_signal("billing.plan.*")
+	data = get_fixture("webhooks/billing.plan.created.json")
+	data.update(id="WH-BILLING-PLAN-DELETED", event_type="BILLING.PLAN.DELETED")
+	event = models.WebhookEvent.process(data)
+	always_triggers.assert_called_once()
+	on_plan.assert_called_once_with(signal=None, sender=models.WebhookEvent, event=event)
+
+
+def process_test_event(event_type):
+	data = get_fixture("webhooks/billing.plan.created.json")
+	data.update(id="WH-" + event_type, event_type=event_type)
+	return models.WebhookEvent.process(data)
+
+
+@pytest.mark.django_db
+def test_deferred_webhook_handlers():
+	handled_events.clear()
+	event = process_test_event("TEST.HANDLER.DEFERRED")
+	failed_event = process_test_event("TEST.HANDLER.FAILED")
+	assert not handled_events
+	assert models.WebhookHandlerJob.objects.filter(status="pending").count() == 2
+
+	stderr = StringIO()
+	call_command("djpaypal_run_webhook_handlers", stdout=StringIO(), stderr=stderr)
+	assert handled_events == [event.id]
+	assert "Handler failed" in stderr.getvalue()
+
+	job = models.WebhookHandlerJob.objects.get(webhook_event=event)
+	assert job.status == "succeeded"
+	assert job.handler == "tests.test_webhooks.on_test_event_deferred"
+	assert job.started and job.duration_ms is not None
+	failed_job = models.WebhookHandlerJob.objects.get(webhook_event=failed_event)
+	assert failed_job.status == "failed"
+	assert failed_job.exception == "Handler failed"
+
+
+@pytest.mark.django_db
+def test_sync_webhook_handlers_run_after_transaction():
+	handled_events.clear()
+	depth = len(connection.atomic_blocks)
+	with pytest.raises(Exception, match="Sync handler failed"):
+		process_test_event("TEST.HANDLER.SYNC")
+
+	# The handler ran outside of the event transaction, so its exception
+	# did not roll back the event nor its deferred handler job
+	assert handled_events == [("WH-TEST.HANDLER.SYNC", depth)]
+	event = models.WebhookEvent.objects.get(id="WH-TEST.HANDLER.SYNC")
+	assert models.WebhookHandlerJob.objects.get(webhook_event=event).status == "pending"
+
+
+@pytest.mark.django_db
+def test_stale_webhook_handler_jobs(admin_client):
+	handled_events.clear()
+	event = process_test_event("TEST.HANDLER.DEFERRED")
+	job = models.WebhookHandlerJob.objects.get(webhook_event=event)
+
+	# A job whose worker died while running it is left alone until it is stale
+	models.WebhookHandlerJob.objects.update(status="running", started=timezone.now())
+	assert models.WebhookHandlerJob.process_pending() == []
+	admin_client.post("/admin/djpaypal/webhookhandlerjob/", {
+		"action": "requeue", "_selected_action": [job.id],
+	})
+	job.refresh_from_db()
+	assert job.status == "running"
+
+	models.WebhookHandlerJob.objects.update(started=timezone.now() - timedelta(hours=1))
+	admin_client.post("/admin/djpaypal/webhookhandlerjob/", {
+		"action": "requeue", "_selected_action": [job.id],
+	})
+	job.refresh_from_db()
+	assert job.status == "pending"
+
+	models.WebhookHandlerJob.objects.update(
+		status="running", started=timezone.now() - timedelta(hours=1)
+	)
+	assert [j.id for j in models.WebhookHandlerJob.process_pending()] == [job.id]
+	job.refresh_from_db()
+	assert job.status == "succeeded"
+	assert handled_events == [event.id]
+
+
+@pytest.mark.django_db
+def test_async_webhook_handlers(django_capture_on_commit_callbacks):
+	handled_events.clear()
+	executor = mock.Mock()
+	executor.submit.side_effect = lambda func, *args: func(*args)
+	with mock.patch("djpaypal.models.webhooks.get_executor", return_value=executor):
+		with django_capture_on_commit_callbacks(execute=True):
+			event = process_test_event("TEST.HANDLER.ASYNC")
+			assert not handled_events
+
+	assert handled_events == [event.id]
+	# The async job ran in the "thread pool", the deferred one is still pending
+	assert models.WebhookHandlerJob.objects.get(
+		webhook_event=event, handler="tests.test_webhooks.on_test_event_async"
+	).status == "succeeded"
+	assert models.WebhookHandlerJob.objects.get(
+		webhook_event=event, handler="tests.test_webhooks.on_test_event_deferred"
+	).status == "pending"
+
+
 @pytest.mark.django_db
 def test_webhook_customer_dispute_created():
 	data, resource, webhook = get_webhook_from_fixture("customer.dispute.created")
@@ -101,6 +275,16 @@ def test_webhook_risk_dispute_created():
 	# Depends on https://github.com/paypal/PayPal-Python-SDK/issues/216
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize("event_type", ["RISK.DISPUTE.CREATED", "RISK.DISPUTE.UPDATED"])
+def test_webhook_risk_dispute_events_not_synced(event_type):
+	data = get_fixture("webhooks/risk.dispute.created.json")
+	data.update(id="WH-" + event_type, event_type=event_type)
+	event = models.WebhookEvent.process(data)
+	assert event.event_type == event_type
+	assert not models.Dispute.objects.exists()
+
+
 @pytest.mark.django_db
 def test_webhook_payment_sale_completed():
 	data, resource, webhook = get_webhook_from_fixture("payment.sale.completed")
@@ -117,3 +301,240 @@ def test_webhook_payment_sale_completed_from_subscription():
 	assert webhook.webhook_event.id == data["id"]
 	assert webhook.webhook_event.resource["id"] == resource["id"]
 	assert models.Sale.objects.get(id=resource["id"])
+
+
+def make_webhook_request(event_type, transmission_id="b2384410-f8d2-11e7-8b1e"):
+	data = get_fixture("webhooks/{event_type}.json".format(event_type=event_type))
+	return RequestFactory().post(
+		"/webhook/", data=json.dumps(data), content_type="application/json",
+		HTTP_PAYPAL_TRANSMISSION_ID=transmission_id,
+	)
+
+
+@pytest.mark.django_db
+def test_webhook_deferred_processing():
+	request = make_webhook_request("billing.plan.created")
+	trigger = models.WebhookEventTrigger.from_request(request, deferred=True)
+	assert trigger.pending
+	assert not trigger.valid
+	assert not trigger.processed
+
+	with mock.patch.object(models.WebhookEventTrigger, "verify", return_value=True):
+		triggers = models.WebhookEventTrigger.process_pending()
+		assert [t.id for t in triggers] == [trigger.id]
+		assert models.WebhookEventTrigger.process_pending() == []
+
+	trigger.refresh_from_db()
+	assert not trigger.pending
+	assert trigger.valid
+	assert trigger.processed
+	assert trigger.webhook_event.event_type == "BILLING.PLAN.CREATED"
+
+
+@pytest.mark.django_db
+def test_webhook_deferred_processing_claims():
+	trigger = models.WebhookEventTrigger.from_request(
+		make_webhook_request("billing.plan.created"), deferred=True
+	)
+
+	# Triggers claimed by another worker are skipped, until the claim is stale
+	models.WebhookEventTrigger.objects.update(claimed_at=timezone.now())
+	assert models.WebhookEventTrigger.process_pending() == []
+	models.WebhookEventTrigger.objects.update(
+		claimed_at=timezone.now() - timedelta(hours=1)
+	)
+
+	# Verification and processing happen outside of the claim transaction
+	depth = len(connection.atomic_blocks)
+
+	def verify(webhook_id):
+		assert len(connection.atomic_blocks) == depth
+		return True
+
+	with mock.patch.object(models.WebhookEventTrigger, "verify", side_effect=verify):
+		triggers = models.WebhookEventTrigger.process_pending()
+	assert [t.id for t in triggers] == [trigger.id]
+	trigger.refresh_from_db()
+	assert trigger.processed
+	assert trigger.claimed_at is None
+
+
+@pytest.mark.django_db
+def test_webhook_duplicate_delivery():
+	always_triggers.reset_mock()
+	with mock.patch.object(
+		models.WebhookEventTrigger, "verify", side_effect=Exception("Network error")
+	):
+		trigger = models.WebhookEventTrigger.from_request(
+			make_webhook_request("billing.plan.created")
+		)
+	assert trigger.exception == "Network error"
+	assert not trigger.processed
+
+	# Paypal retries the failed delivery
+	with mock.patch.object(models.WebhookEventTrigger, "verify", return_value=True) as verify:
+		retry = models.WebhookEventTrigger.from_request(
+			make_webhook_request("billing.plan.created")
+		)
+		assert retry.id == trigger.id
+		assert retry.processed
+		assert not retry.exception
+		always_triggers.assert_called_once()
+
+		# Further retries are ignored
+		duplicate = models.WebhookEventTrigger.from_request(
+			make_webhook_request("billing.plan.created")
+		)
+		assert duplicate.id == trigger.id
+		verify.assert_called_once()
+		always_triggers.assert_called_once()
+
+	assert models.WebhookEventTrigger.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_webhook_duplicate_delivery_during_processing():
+	view = ProcessWebhookView.as_view()
+	responses = []
+
+	def verify(trigger, webhook_id):
+		# Paypal redelivers the webhook while it is being verified
+		responses.append(view(make_webhook_request("billing.plan.created")))
+		return True
+
+	with mock.patch.object(
+		models.WebhookEventTrigger, "verify", autospec=True, side_effect=verify
+	) as mocked:
+		response = view(make_webhook_request("billing.plan.created"))
+
+	assert response.status_code == 200
+	assert [r.status_code for r in responses] == [200]
+	mocked.assert_called_once()
+	trigger = models.WebhookEventTrigger.objects.get()
+	assert trigger.processed
+	assert trigger.claimed_at is None
+
+
+@pytest.mark.django_db
+def test_reprocess_webhooks_command():
+	triggers = {}
+	for event_type in ("billing.plan.created", "billing.subscription.created"):
+		data = get_fixture("webhooks/{event_type}.json".format(event_type=event_type))
+		triggers[event_type] = models.WebhookEventTrigger.objects.create(
+			headers={}, body=json.dumps(data), remote_ip="0.0.0.0", valid=True,
+			exception="Network error"
+		)
+
+	stdout = StringIO()
+	call_command(
+		"djpaypal_reprocess_webhooks", "--event-type", "BILLING.PLAN.CREATED",
+		"--exception", "network", stdout=stdout
+	)
+	assert "1 processed, 0 errors, 1 skipped" in stdout.getvalue()
+
+	plan_trigger = models.WebhookEventTrigger.objects.get(
+		id=triggers["billing.plan.created"].id
+	)
+	assert plan_trigger.processed
+	assert not plan_trigger.exception
+	assert plan_trigger.webhook_event
+	subscription_trigger = models.WebhookEventTrigger.objects.get(
+		id=triggers["billing.subscription.created"].id
+	)
+	assert not subscription_trigger.processed
+
+
+@pytest.mark.django_db
+def test_async_webhook_view():
+	data = get_fixture("webhooks/billing.plan.created.json")
+
+	def make_request(transmission_id):
+		return AsyncRequestFactory().post(
+			"/webhook/", data=json.dumps(data), content_type="application/json",
+			headers={"paypal-transmission-id": transmission_id},
+		)
+
+	view = async_to_sync(AsyncProcessWebhookView.as_view())
+	with mock.patch.object(models.WebhookEventTrigger, "verify", return_value=True):
+		response = view(make_request("a-transmission-id"))
+		assert response.status_code == 200
+		trigger = models.WebhookEventTrigger.objects.get(id=int(response.content))
+		assert trigger.processed
+		assert trigger.webhook_event.id == data["id"]
+
+		# Duplicate deliveries are not processed again
+		assert view(make_request("a-transmission-id")).content == response.content
+
+	trigger = async_to_sync(models.WebhookEventTrigger.afrom_request)(
+		make_request("another-transmission-id"), deferred=True
+	)
+	assert trigger.pending
+	assert not trigger.processed
+
+
+@pytest.mark.django_db
+def test_webhook_compressed_body():
+	request = make_webhook_request("billing.plan.created")
+	with mock.patch("djpaypal.models.webhooks.PAYPAL_WEBHOOK_BODY_COMPRESSION", "zlib"):
+		with mock.patch("djpaypal.models.webhooks.json.loads", wraps=json.loads) as loads:
+			with mock.patch(
+				"djpaypal.models.webhooks.verify_webhook", return_value=True
+			) as verify:
+				trigger = models.WebhookEventTrigger.from_request(request)
+			# The body is only parsed once
+			loads.assert_called_once()
+
+	assert trigger.processed
+	assert verify.call_args.kwargs["event_body"] == request.body.decode()
+
+	trigger = models.WebhookEventTrigger.objects.get(id=trigger.id)
+	assert not trigger.body
+	assert len(trigger.body_compressed) < len(request.body)
+	assert trigger.raw_body == request.body.decode()
+	assert trigger.event_type == "BILLING.PLAN.CREATED"
+
+
+@pytest.mark.django_db
+def test_prune_webhooks_command(tmp_path):
+	old, recent = timezone.now() - timedelta(days=100), timezone.now()
+	triggers = {}
+	for name, valid, processed, created in (
+		("old_processed", True, True, old),
+		("recent_processed", True, True, recent),
+		("old_failed", True, False, old),
+		("old_invalid", False, False, old),
+	):
+		data = get_fixture("webhooks/billing.plan.created.json")
+		data["id"] = "WH-" + name
+		trigger = models.WebhookEventTrigger.objects.create(
+			headers={}, body=json.dumps(data), remote_ip="0.0.0.0", valid=valid
+		)
+		if processed:
+			trigger.process()
+			models.WebhookEvent.objects.filter(id=data["id"]).update(create_time=created)
+		models.WebhookEventTrigger.objects.filter(id=trigger.id).update(created=created)
+		triggers[name] = trigger
+
+	stdout = StringIO()
+	call_command(
+		"djpaypal_prune_webhooks", "--processed", "30", "--invalid", "30",
+		"--batch-size", "1", "--archive", str(tmp_path), stdout=stdout
+	)
+	assert "Pruned 1 processed webhook triggers" in stdout.getvalue()
+	assert "Pruned 1 invalid webhook triggers" in stdout.getvalue()
+	assert "Pruned 1 webhook events" in stdout.getvalue()
+
+	assert set(models.WebhookEventTrigger.objects.values_list("id", flat=True)) == {
+		triggers["recent_processed"].id, triggers["old_failed"].id
+	}
+	assert list(models.WebhookEvent.objects.values_list("id", flat=True)) == [
+		"WH-recent_processed"
+	]
+
+	archive, = tmp_path.iterdir()
+	with gzip.open(archive, "rt") as f:
+		archived = [json.loads(line) for line in f]
+	assert [obj["model"] for obj in archived] == [
+		"djpaypal.webhookeventtrigger", "djpaypal.webhookeventtrigger", "djpaypal.webhookevent"
+	]
+	assert json.loads(archived[0]["fields"]["body"])["id"] == "WH-old_processed"